@@ -0,0 +1,220 @@
+"""
+Micro-benchmarks for the hot paths of BlockBet.
+
+Usage: python3 bench.py [benchmark ...]
+Runs every benchmark when none is named.
+"""
+import binascii
+import contextlib
+import hashlib
+import io
+import random
+import socket
+import struct
+import sys
+import threading
+import time
+
+from difficulty import header_meets_target, zeros_to_target
+from message import block_v2_header_fmt, block_version_fmt, hash_header_fmt, unpack_varint
+from miner import BATCH_SIZE, HeaderSearch
+
+ZEROS = 22
+
+
+def timed(fn, n):
+    """
+    Call fn(i) for i in range(n) and return the rate in calls/sec
+    """
+    start = time.perf_counter()
+    for i in range(n):
+        fn(i)
+    return n / (time.perf_counter() - start)
+
+
+def report(name, rate, unit):
+    print("%-40s %12.0f %s" % (name, rate, unit))
+
+
+def bench_verify_nonce(n=200000):
+    """
+    Hashes/sec of a header check with the old string-formatted prefix test
+    against the byte-level target comparison
+    """
+    prev_hash = hashlib.sha256(b"bench").digest()
+    timestamp = int(time.time())
+    target = zeros_to_target(ZEROS)
+
+    def string_check(nonce):
+        header = struct.pack(hash_header_fmt, prev_hash, timestamp, nonce)
+        dgst = hashlib.sha256(header).digest()
+        bin_str = '{:0256b}'.format(int(binascii.hexlify(dgst), 16))
+        return bin_str[:ZEROS] == '0' * ZEROS
+
+    def target_check(nonce):
+        header = struct.pack(hash_header_fmt, prev_hash, timestamp, nonce)
+        return header_meets_target(header, target)
+
+    report("verify_nonce: binary string prefix", timed(string_check, n), "hashes/sec")
+    report("verify_nonce: byte target", timed(target_check, n), "hashes/sec")
+
+
+def bench_mining(batches=50):
+    """
+    Hashes/sec of the old per-attempt mining loop (random nonce, fresh
+    timestamp and struct.pack every time) against the batched sequential
+    search over a preallocated header
+    """
+    prev_hash = hashlib.sha256(b"bench").digest()
+    target = zeros_to_target(256)  # never met, so every nonce gets tried
+    n = batches * BATCH_SIZE
+
+    def per_attempt(_):
+        timestamp = int(time.time())
+        nonce = random.randint(1, 10**9)
+        header = struct.pack(hash_header_fmt, prev_hash, timestamp, nonce)
+        return header_meets_target(header, target)
+
+    search = HeaderSearch(prev_hash, target)
+
+    def batched(i):
+        search.search_batch(i * BATCH_SIZE, BATCH_SIZE)
+
+    report("mining: per-attempt pack", timed(per_attempt, n), "hashes/sec")
+    report("mining: batched in place", timed(batched, batches) * BATCH_SIZE, "hashes/sec")
+
+
+def _drain_listener():
+    """
+    A local listener that accepts connections and discards whatever is sent.
+    It listens on every address, so 127.0.0.x can stand in for x different peers.
+    """
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('', 0))
+    listener.listen(128)
+
+    def drain(conn):
+        while conn.recv(65536):
+            pass
+        conn.close()
+
+    def accept():
+        while True:
+            conn, _ = listener.accept()
+            threading.Thread(target=drain, args=(conn,), daemon=True).start()
+
+    threading.Thread(target=accept, daemon=True).start()
+    return listener.getsockname()[1]
+
+
+def bench_signing(n=200):
+    """
+    Signatures/sec when the private key is imported for every message against
+    a Signer that keeps the imported key, then the latency of a broadcast to
+    1, 10 and 100 local peers: signing plus serial connect/send/close per peer,
+    against one signature handed to the persistent connection pool
+    """
+    from Crypto.Hash import SHA256
+    from Crypto.PublicKey import RSA
+    from Crypto.Signature import PKCS1_v1_5
+    from peer import ConnectionPool, Signer, pack_frame
+
+    key = RSA.generate(1024)
+    pem = key.export_key()
+    data = struct.pack('I', 4) + bytes(1000)
+
+    def import_and_sign(_):
+        PKCS1_v1_5.new(RSA.importKey(pem)).sign(SHA256.new(data))
+
+    signer = Signer(key)
+
+    report("signing: import key every time", timed(import_and_sign, n), "signatures/sec")
+    report("signing: imported once", timed(lambda _: signer.sign(data), n), "signatures/sec")
+
+    port = _drain_listener()
+    pool = ConnectionPool(port)
+    results = []
+    # keep the per-message prints of the connection threads out of the report
+    with contextlib.redirect_stdout(io.StringIO()):
+        for peers in (1, 10, 100):
+            hosts = ['127.0.0.%d' % (i + 1) for i in range(peers)]
+
+            start = time.perf_counter()
+            frame = pack_frame(data, PKCS1_v1_5.new(RSA.importKey(pem)).sign(SHA256.new(data)))
+            for host in hosts:
+                fd = socket.create_connection((host, port))
+                fd.sendall(frame)
+                fd.close()
+            serial = time.perf_counter() - start
+
+            # first broadcast opens the connections, time the second one
+            for _ in range(2):
+                start = time.perf_counter()
+                sent = sum(conn['sent'] for conn in pool.stats().values())
+                pool.send(hosts, pack_frame(data, signer.sign(data)))
+                while sum(conn['sent'] for conn in pool.stats().values()) < sent + peers:
+                    time.sleep(0.0005)
+                pooled = time.perf_counter() - start
+            results.append((peers, serial, pooled))
+        pool.close()
+
+    for peers, serial, pooled in results:
+        report("broadcast to %d peers: serial connect" % peers, serial * 1000, "ms")
+        report("broadcast to %d peers: pooled" % peers, pooled * 1000, "ms")
+
+
+def bench_parse(blocks=10000, bets_per_block=5):
+    """
+    Blocks/sec parsing a chain of 10k version 2 blocks when each block is parsed
+    from a copy of the rest of the buffer, against lazy views of one memoryview,
+    with and without reading the bets
+    """
+    from bet import OpenBet
+    from blockchain import Block, Blockchain, parse_blocks
+    from verifier import parse_headers
+
+    bets = [OpenBet('0', '10.0.0.1', 'event %d' % i, 'win', '50', time.time()).to_bytes()
+            for i in range(bets_per_block)]
+    data = b''.join(Blockchain.add_block_bytes(Block(bytes(32), i, i, len(bets), bets))
+                    for i in range(blocks))
+    _, offsets = parse_headers(data)
+
+    def copying(_):
+        for offset in offsets:
+            rest = data[offset:]
+            prev_hash, timestamp, nonce = struct.unpack_from(hash_header_fmt, rest)
+            bet_num, _ = struct.unpack_from(block_version_fmt, rest, struct.calcsize(hash_header_fmt))
+            pos = struct.calcsize(block_v2_header_fmt)
+            for _ in range(bet_num):
+                length, pos = unpack_varint(rest, pos)
+                bytes(rest[pos:pos + length])
+                pos += length
+
+    def views(_):
+        parse_blocks(data, offsets)
+
+    def views_and_bets(_):
+        for block in parse_blocks(data, offsets):
+            block.bets
+
+    report("parse: copy of the rest per block", timed(copying, 1) * blocks, "blocks/sec")
+    report("parse: memoryview, headers only", timed(views, 3) * blocks, "blocks/sec")
+    report("parse: memoryview, with bets", timed(views_and_bets, 3) * blocks, "blocks/sec")
+
+
+BENCHMARKS = {
+    "verify_nonce": bench_verify_nonce,
+    "mining": bench_mining,
+    "signing": bench_signing,
+    "parse": bench_parse,
+}
+
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            print("[ERROR] Unknown benchmark: %s" % name)
+            exit(1)
+        BENCHMARKS[name]()
@@ -1,13 +1,88 @@
+import heapq
+import math
+import os
+import re
 import sys
 import select
 import time
 import uuid
 import threading
-from typing import Dict, Any
+from bisect import bisect_left, insort
+from collections import deque
+from itertools import islice
+from typing import Dict, Any, List, Optional, Set, Tuple
 
+from mempool import Mempool
 from peer import Peer
 import struct
-from message import MessageType, bet_fmt
+from message import MessageType, pack_varint, unpack_varint
+
+# First byte of a binary encoded bet. Bets of version 1 blocks are '|'-separated
+# strings padded to bet_fmt instead, and start with 'o' or 'c'.
+BET_OPEN = 1
+BET_CLOSED = 2
+_float = struct.Struct('<d')
+UUID_SIZE = 16
+
+# Undo records are kept for this many of the last applied blocks, deeper
+# reorganizations start over from the checkpoint
+UNDO_DEPTH = 100
+# A checkpoint of the bet list is taken every this many blocks
+CHECKPOINT_INTERVAL = 100
+# Checkpoint file: height and hash of its last block, then the open bets
+# as varint-prefixed binary bets
+checkpoint_fmt = '<I32s'
+_checkpoint = struct.Struct(checkpoint_fmt)
+# Orders of the paged bet queries
+SORT_KEYS = ("expire", "amount")
+
+
+def pack_str(value):
+    """
+    A string as its UTF-8 length in a varint, followed by the UTF-8 bytes
+    """
+    data = value.encode('utf-8')
+    return pack_varint(len(data)) + data
+
+
+def unpack_str(data, pos):
+    """
+    @return: (string, offset right after it)
+    """
+    length, pos = unpack_varint(data, pos)
+    if pos + length > len(data):
+        raise ValueError("Truncated string")
+    return bytes(data[pos:pos + length]).decode('utf-8'), pos + length
+
+
+def keywords(text):
+    """
+    Lowercase words of an event or win condition, as indexed by BetList
+    """
+    return set(re.findall(r'\w+', text.lower()))
+
+
+def pool_key(bet):
+    """
+    Mempool key of a bet. An open bet and the closed bet calling it share their id,
+    so only one call of a bet is kept pending.
+    """
+    return isinstance(bet, ClosedBet), bet.id
+
+
+def bet_amount(bet):
+    try:
+        return float(bet.amt)
+    except ValueError:  # amounts of version 1 blocks were never checked
+        return 0.0
+
+
+def valid_number(value):
+    """
+    Amounts and expirations have to be finite and positive, a NaN would break
+    the order of the sorted indexes and of the mempool
+    """
+    return math.isfinite(value) and value > 0
 
 
 class Bet:
@@ -45,6 +120,15 @@ class OpenBet(Bet):
         self.amt = amt
         self.expire = float(expiration)  # current expiration of bets is after one minute
 
+    def to_bytes(self):
+        """
+        Binary encoding: BET_OPEN, 16-byte UUID, originator, event info and win condition
+        as varint-prefixed strings, then amount and expiration as float64
+        """
+        return bytes([BET_OPEN]) + uuid.UUID(self.id).bytes + pack_str(self.originator) \
+            + pack_str(self.event_info) + pack_str(self.win_cond) \
+            + _float.pack(float(self.amt)) + _float.pack(self.expire)
+
     def __repr__(self):
         return 'open|' + self.id + "|" + self.originator + "|" + self.event_info + "|"\
                     + self.win_cond + "|" + self.amt + "|" + str(self.expire) + "|"
@@ -63,6 +147,12 @@ class ClosedBet(Bet):
         self.caller = caller
         self.expire = float("inf")
 
+    def to_bytes(self):
+        """
+        Binary encoding: BET_CLOSED, 16-byte UUID of the called bet, caller as a varint-prefixed string
+        """
+        return bytes([BET_CLOSED]) + uuid.UUID(self.id).bytes + pack_str(self.caller)
+
     def __repr__(self):
         return 'closed|' + self.id + "|" + self.caller
 
@@ -70,71 +160,116 @@ class ClosedBet(Bet):
 class BetList:
     """
     BetList keeps the internal list of open bets that are avalible to be called
-    BetList is updated after each sucessful 
+    BetList follows the blockchain block by block: the bets of a new block are
+    applied to it, and undone again when the block is replaced by a fork
     """
     # Type hint
     betList: Dict[str, OpenBet]
 
-    def __init__(self, peer: Peer):
+    def __init__(self, peer: Peer, checkpoint=None):
+        """
+        @param checkpoint: optional file the bet list is checkpointed to, and restored from on start
+        """
         self.peer = peer
-        self.betList = {}  # Type dictionary with key:id, value, Bet
-        self.currentRoundBets = []
+        self.betList = {}  # Type dictionary with key:id, value, Bet. Open bets confirmed by the blockchain
+        self.mempool = Mempool()  # bets waiting to be put on a block
+        self.calledBets = set()  # ids of bets I called, hidden until my blockchain changes
+        self.expiry = []  # heap of (expire, id) of open and called bets, evicted lazily once expired
+        self.calls = {}  # type: Dict[str, Tuple[OpenBet, str]]  # id -> (bet, caller) of called bets
+        # Secondary indexes of the confirmed bets
+        self.byOriginator = {}  # type: Dict[str, Set[str]]  # originator -> ids of open bets
+        self.byCaller = {}  # type: Dict[str, Set[str]]  # caller -> ids of called bets
+        self.byKeyword = {}  # type: Dict[str, Set[str]]  # event and win condition word -> ids of open bets
+        self.sorted = {key: [] for key in SORT_KEYS}  # type: Dict[str, List[Tuple[float, str]]]  # sorted (key, id) of open bets
+        self.hashes = []  # type: List[Optional[bytes]]  # hash of every applied block, None below a restored checkpoint
+        self.undoLog = deque(maxlen=UNDO_DEPTH)  # per applied block, the (id, previous bet, caller) it changed and its bets
+        self.checkpoint = None  # (height, hash, betList, calls) of the last checkpoint
+        self.checkpoint_path = checkpoint
+        self.lock = threading.Lock()
+        if checkpoint is not None and os.path.exists(checkpoint):
+            self.load_checkpoint(checkpoint)
 
     def receive_bets(self, data, src):
         """
-        When a new is heard from it's peers, add it to the currentRoundBets
+        When a new is heard from it's peers, add it to the mempool
         """
         print("Receive a bet:", data[:100], "number of bytes", len(data), "from", src)
         data = data[struct.calcsize("I"):]  # skip message type field
 
-        byte_bet, = struct.unpack_from(bet_fmt, data)
-        string_bet = byte_bet.decode("utf-8")
-        self.currentRoundBets.append(self.string_to_bet(string_bet))
-        print("current round bets:", self.currentRoundBets)
-
-    def collect_bets(self, n):
+        try:
+            bet = self.bytes_to_bet(data)
+        except ValueError as e:
+            print("[INFO] Dropped an invalid bet from", src, ":", e)
+            return
+        with self.lock:
+            added = self.add_pending(bet, bytes(data))
+        if not added:
+            print("[INFO] Dropped a duplicate or conflicting bet from", src)
+            return
+        print("pending bets:", len(self.mempool))
+
+    def add_pending(self, bet, data):
         """
-        Gives blockchain a list of n bets from the current round to add to bloack
+        Add a bet to the mempool, unless it is already pending or confirmed, or it
+        calls a bet that is unknown or already called. Calls rank by the amount of
+        the bet they call.
+        @param data: the encoded bet
+        @return: True if it was added
         """
-        return_list = []
-
-        if len(self.currentRoundBets) < n:
-            return_list = self.betList_ts(self.currentRoundBets)
-            self.update_bets(self.currentRoundBets)
-            self.currentRoundBets = []
+        if isinstance(bet, ClosedBet):
+            openBet = self.betList.get(bet.id) or self.mempool.get((False, bet.id))
+            if openBet is None:
+                return False
+        elif bet.id in self.betList or bet.id in self.calls:
+            return False
         else:
-            return_list = self.betList_ts(self.currentRoundBets[0:n])
-            self.update_bets(self.currentRoundBets[0:n])
-            self.currentRoundBets = self.currentRoundBets[n:]
+            openBet = bet
+        return self.mempool.add(pool_key(bet), bet, data, bet_amount(openBet))
 
-        return return_list
-
-    def update_bets(self, updatedBets):
+    def collect_bets(self, max_bytes):
         """
-        Updates the master list of open bets
-        @param updatedBets: list of string bets that are confirmed from chain
+        Gives blockchain a list of the best pending bets that fit in max_bytes to add to bloack. They
+        stay pending until a block with them is applied. Open bets come first,
+        so a bet called in the same block is open when its call is applied.
         """
-        for bet in updatedBets:
-            if isinstance(bet, ClosedBet):
-                try:
-                    self.betList.pop(bet.id)  # remove all bets that were closed
-                except:
-                    print(f"[ERR] {bet.id}")
-            elif isinstance(bet, OpenBet):
-                self.betList[bet.id] = bet  # add sucessully placed bets
-
-        # remove expired bets
-        self.betList = {k: v for k, v in self.betList.items() if not self.is_expired(v)}
+        now = time.time()
+        chosen = set()
+
+        def accept(key, bet):
+            closed, id = key
+            if not closed:
+                if bet.expire < now:
+                    return None  # expired before it was mined
+                chosen.add(id)
+                return True
+            if id in self.betList or id in chosen:
+                return True
+            if (False, id) in self.mempool:
+                return False  # wait until its bet is taken first
+            return None  # its bet was called or expired meanwhile
+
+        with self.lock:
+            self.evict_expired(now)
+            taken = self.mempool.select(None, accept, max_bytes)
+        taken.sort(key=lambda item: item[0][0])
+        return [data for _, _, data in taken]
 
     def place_bet(self, origin, info, winCond, amt, expiration):
         """
         Returns new open bet object (as a string) to peer to be braodcasted
         """
+        try:
+            if not valid_number(float(amt)) or not valid_number(float(expiration)):
+                raise ValueError
+        except ValueError:
+            print("bet amount and expiration must be positive numbers")
+            return
         newBet = OpenBet('0', origin, info, winCond, amt, time.time() + float(expiration) * 60)
         request = struct.pack("I", MessageType.NEW_BET)
-        request += struct.pack(bet_fmt, bytes(repr(newBet), 'utf-8'))
-        self.currentRoundBets.append(newBet)
-        self.peer.send_signed_data(request)
+        request += newBet.to_bytes()
+        with self.lock:
+            self.add_pending(newBet, newBet.to_bytes())
+        self.peer.send_signed_data(request, batch=True)
         return repr(newBet)
 
     def call_bet(self, betId, caller):
@@ -144,52 +279,138 @@ class BetList:
         request = struct.pack("I", MessageType.NEW_BET)
 
         newClosedBet = ClosedBet(betId, caller)
-        if betId not in self.betList or self.is_expired(self.betList[betId]):
-            print("bet id doesn't exits or bet is expired")
-            return  # check the it isn't expired
-
-        request += struct.pack(bet_fmt, bytes(repr(newClosedBet), 'utf-8'))
-        self.betList.pop(betId)
-        self.currentRoundBets.append(newClosedBet)
-        self.peer.send_signed_data(request)
+        with self.lock:
+            self.evict_expired(time.time())
+            if betId not in self.betList or betId in self.calledBets:
+                print("bet id doesn't exits or bet is expired")
+                return  # check the it isn't expired
+            if not self.add_pending(newClosedBet, newClosedBet.to_bytes()):
+                print("bet is already called")
+                return
+            self.calledBets.add(betId)
+
+        request += newClosedBet.to_bytes()
+        self.peer.send_signed_data(request, batch=True)
         return repr(newClosedBet)
 
-    def get_open_bets(self):
+    def query(self, originator=None, caller=None, keyword=None, sort="expire", reverse=False, offset=0, limit=None):
         """
-        Returns string list of bets that are callable
+        One page of the open bets matching every given filter, or with caller,
+        of the bets that caller called. Filtered queries cost the size of the
+        smallest matching index, unfiltered ones walk the sorted index.
+        @param originator: only bets placed by this peer
+        @param caller: only bets called by this peer
+        @param keyword: words that must all appear in the event or win condition
+        @param sort: one of SORT_KEYS
+        @return: list of bets
         """
-        open_bets = []
-        for bet in self.betList.values():
-            if not self.is_expired(bet) and isinstance(bet, OpenBet):
-                open_bets.append({
-                    "uuid": bet.id,
-                    "event": bet.event_info,
-                    "amount": bet.amt,
-                    "expiration": bet.expire,
-                    "win_condition": bet.win_cond,
-                    "outcome": -1, # DUMMY, just to meet GUI expectation -- GUI doesnt need
-                })
-        return open_bets
+        if sort not in SORT_KEYS:
+            raise ValueError("Unknown sort key: %s" % sort)
+        stop = offset + limit if limit is not None else None
+        with self.lock:
+            self.evict_expired(time.time())
+            sets = []
+            if originator is not None:
+                sets.append(self.byOriginator.get(originator, set()))
+            if keyword:
+                sets.extend(self.byKeyword.get(word, set()) for word in keywords(keyword))
+            if caller is not None:
+                ids = self.byCaller.get(caller, set()).intersection(*sets)
+                bets = [self.calls[id][0] for id in ids]
+            elif sets:
+                sets.sort(key=len)
+                ids = sets[0].intersection(*sets[1:])
+                bets = [self.betList[id] for id in ids if id not in self.calledBets]
+            else:
+                index = self.sorted[sort]
+                ids = (id for _, id in (reversed(index) if reverse else index) if id not in self.calledBets)
+                return [self.betList[id] for id in islice(ids, offset, stop)]
+        bets.sort(key=(lambda bet: bet.expire) if sort == "expire" else bet_amount, reverse=reverse)
+        return bets[offset:stop]
+
+    @staticmethod
+    def bet_dict(bet):
+        return {
+            "uuid": bet.id,
+            "event": bet.event_info,
+            "amount": bet.amt,
+            "expiration": bet.expire,
+            "win_condition": bet.win_cond,
+            "outcome": -1, # DUMMY, just to meet GUI expectation -- GUI doesnt need
+        }
+
+    def get_open_bets(self, offset=0, limit=None):
+        """
+        Returns string list of bets that are callable, soonest expiring first
+        """
+        return [self.bet_dict(bet) for bet in self.query(offset=offset, limit=limit)]
 
-    def get_user_bets(self, userId):
+    def get_user_bets(self, userId, offset=0, limit=None):
         """
         Returns list of bets for a given user
         @param userID: string ID of the user
         """
-        userBets = []
-        for bet in self.betList.values():
-            if not self.is_expired(bet) and bet.originator == userId:
-                userBets.append({
-                    "uuid": bet.id,
-                    "event": bet.event_info,
-                    "amount": bet.amt,
-                    "expiration": bet.expire,
-                     "outcome": -1, # DUMMY, just to meet GUI expectation
-                })
-        return userBets
-
-    def is_expired(self, openbet):
-        return time.time() > openbet.expire
+        return [self.bet_dict(bet) for bet in self.query(originator=userId, offset=offset, limit=limit)]
+
+    def is_expired(self, openbet, now=None):
+        return (time.time() if now is None else now) > openbet.expire
+
+    def evict_expired(self, now):
+        """
+        Drop the open bets that expired by now, earliest first. Entries of bets
+        that were closed or replaced meanwhile are skipped.
+        @param now: the clock value used for the whole query
+        """
+        expiry = self.expiry
+        while expiry and expiry[0][0] < now:
+            expire, id = heapq.heappop(expiry)
+            bet = self.betList.get(id)
+            if bet is not None and bet.expire == expire:
+                self._remove(id)
+            call = self.calls.get(id)
+            if call is not None and call[0].expire == expire:
+                self._uncall(id)
+
+    def _add(self, bet):
+        # an open bet, in betList and every index
+        if bet.id in self.betList:
+            self._remove(bet.id)
+        self.betList[bet.id] = bet
+        self.byOriginator.setdefault(bet.originator, set()).add(bet.id)
+        for word in keywords(bet.event_info + " " + bet.win_cond):
+            self.byKeyword.setdefault(word, set()).add(bet.id)
+        insort(self.sorted["expire"], (bet.expire, bet.id))
+        insort(self.sorted["amount"], (bet_amount(bet), bet.id))
+        heapq.heappush(self.expiry, (bet.expire, bet.id))
+
+    def _remove(self, id):
+        bet = self.betList.pop(id)
+        self._discard(self.byOriginator, bet.originator, id)
+        for word in keywords(bet.event_info + " " + bet.win_cond):
+            self._discard(self.byKeyword, word, id)
+        for key, value in (("expire", bet.expire), ("amount", bet_amount(bet))):
+            index = self.sorted[key]
+            pos = bisect_left(index, (value, id))
+            assert index[pos][1] == id, "sorted bet index out of order"
+            del index[pos]
+        return bet
+
+    def _call(self, bet, caller):
+        self.calls[bet.id] = (bet, caller)
+        self.byCaller.setdefault(caller, set()).add(bet.id)
+
+    def _uncall(self, id):
+        call = self.calls.pop(id, None)
+        if call is not None:
+            self._discard(self.byCaller, call[1], id)
+
+    @staticmethod
+    def _discard(index, key, id):
+        ids = index.get(key)
+        if ids is not None:
+            ids.discard(id)
+            if not ids:
+                del index[key]
 
     def string_to_bet(self, stringBet):
         """
@@ -203,22 +424,176 @@ class BetList:
         print(type(strBet[0]), strBet[0], repr(strBet[0]))
         raise Exception("Invalid bet", stringBet)
 
+    def bytes_to_bet(self, data):
+        """
+        helper function that translates from binary encoded bets to bets,
+        or from the padded strings of version 1 blocks
+        @raise ValueError: if an open bet's amount or expiration is not a finite, positive number
+        """
+        kind = data[0] if len(data) > 0 else None
+        if kind == BET_OPEN:
+            id = str(uuid.UUID(bytes=bytes(data[1:1 + UUID_SIZE])))
+            origin, pos = unpack_str(data, 1 + UUID_SIZE)
+            info, pos = unpack_str(data, pos)
+            winCond, pos = unpack_str(data, pos)
+            amt, = _float.unpack_from(data, pos)
+            expire, = _float.unpack_from(data, pos + _float.size)
+            if not valid_number(amt) or not valid_number(expire):
+                raise ValueError("Invalid bet amount or expiration")
+            # amounts were entered as strings, keep whole amounts without a trailing '.0'
+            amt = str(int(amt)) if amt.is_integer() else repr(amt)
+            return OpenBet(id, origin, info, winCond, amt, expire)
+        if kind == BET_CLOSED:
+            id = str(uuid.UUID(bytes=bytes(data[1:1 + UUID_SIZE])))
+            caller, _ = unpack_str(data, 1 + UUID_SIZE)
+            return ClosedBet(id, caller)
+        bet = self.string_to_bet(bytes(data).rstrip(b'\0').decode("utf-8"))
+        if isinstance(bet, OpenBet) and (not valid_number(bet_amount(bet)) or not valid_number(bet.expire)):
+            raise ValueError("Invalid bet amount or expiration")
+        return bet
+
     def betList_ts(self, betlist):
-        stringBets = []
-        for bet in betlist:
-            stringBets.append(struct.pack(bet_fmt, bytes(repr(bet), 'utf-8')))
+        return [bet.to_bytes() for bet in betlist]
 
-        return stringBets
+    @property
+    def height(self):
+        """
+        Number of blocks applied to the bet list
+        """
+        return len(self.hashes)
 
-    def update_betlist(self, bet_strings):
-        new_betlist = {}
-        for bet_s in bet_strings:
-            string_bet = bet_s.decode("utf-8")
-            bet = self.string_to_bet(string_bet)
+    def apply_block(self, dgst, bet_bytes):
+        """
+        Apply the bets of the next block: open bets are added, closed bets removed
+        @param dgst: header hash of the block
+        @param bet_bytes: the encoded bets of the block
+        """
+        undo = []
+        for bet_b in bet_bytes:
+            try:
+                bet = self.bytes_to_bet(bet_b)
+            except ValueError:
+                continue  # not a valid bet, it changes nothing
+            self.mempool.remove(pool_key(bet))
             if isinstance(bet, OpenBet):
-                new_betlist[bet.id] = bet
-            elif bet.id in new_betlist:
-                new_betlist.pop(bet.id)
-
-        self.betList = new_betlist
-        print("current bet list on the blockchain:", self.betList)
\ No newline at end of file
+                undo.append((bet.id, self.betList.get(bet.id), None))
+                self._add(bet)
+            elif bet.id in self.betList:
+                prev = self._remove(bet.id)
+                self._call(prev, bet.caller)
+                undo.append((bet.id, prev, bet.caller))
+        self.undoLog.append((undo, bet_bytes))
+        self.hashes.append(dgst)
+
+    def undo_block(self):
+        """
+        Undo the last applied block
+        @return: its bets
+        """
+        undo, bet_bytes = self.undoLog.pop()
+        for id, prev, caller in reversed(undo):
+            if caller is not None:
+                self._uncall(id)
+            elif id in self.betList:
+                self._remove(id)
+            if prev is not None:
+                self._add(prev)
+        self.hashes.pop()
+        return bet_bytes
+
+    def rewind(self, height):
+        """
+        Undo the blocks above a height. Below the kept undo records the bet list
+        restarts from the last checkpoint under that height, or from empty.
+        The bets of the undone blocks go back to the mempool, unless the blocks
+        that replace them confirm them again.
+        @return: the height reached, at most the requested one
+        """
+        undone = []
+        while self.height > height and self.undoLog:
+            undone.append(self.undo_block())
+        for bet_bytes in reversed(undone):  # oldest first, so bets are pending before their calls
+            for bet_b in bet_bytes:
+                try:
+                    self.add_pending(self.bytes_to_bet(bet_b), bytes(bet_b))
+                except ValueError:
+                    pass  # skipped when the block was applied too
+        if self.height > height:
+            if self.checkpoint is not None and self.checkpoint[0] <= height:
+                self.restore_checkpoint(*self.checkpoint)
+            else:
+                self.restore_checkpoint(0, None, {}, {})
+        return self.height
+
+    def update_chain(self, blocks):
+        """
+        Bring the bet list up to date with the blockchain: undo the applied blocks
+        that are no longer on it, then apply the new ones
+        @param blocks: the blockchain, blocks with hash and bets
+        """
+        with self.lock:
+            self.evict_expired(time.time())
+            common = min(self.height, len(blocks))
+            while common > 0 and self.hashes[common - 1] != blocks[common - 1].hash:
+                common -= 1
+            for block in blocks[self.rewind(common):]:
+                self.apply_block(block.hash, block.bets)
+                if self.height % CHECKPOINT_INTERVAL == 0:
+                    self.take_checkpoint()
+            self.calledBets.clear()
+        print("current bet list on the blockchain:", len(self.betList), "bets at height", self.height)
+
+    def take_checkpoint(self):
+        """
+        Remember the bet list at the current height, and save it if a checkpoint file is set
+        """
+        self.checkpoint = (self.height, self.hashes[-1] if self.hashes else None, dict(self.betList), dict(self.calls))
+        if self.checkpoint_path is not None:
+            self.save_checkpoint(self.checkpoint_path)
+
+    def restore_checkpoint(self, height, dgst, betList, calls):
+        self.betList, self.calls, self.expiry = {}, {}, []
+        self.byOriginator, self.byCaller, self.byKeyword = {}, {}, {}
+        self.sorted = {key: [] for key in SORT_KEYS}
+        for bet in betList.values():
+            self._add(bet)
+        for bet, caller in calls.values():
+            self._call(bet, caller)
+            heapq.heappush(self.expiry, (bet.expire, bet.id))
+        self.hashes = [None] * (height - 1) + [dgst] if height > 0 else []
+        self.undoLog.clear()
+
+    def save_checkpoint(self, path):
+        height, dgst, betList, calls = self.checkpoint
+        bets = list(betList.values())
+        for bet, caller in calls.values():
+            bets += [bet, ClosedBet(bet.id, caller)]  # a called bet is followed by its ClosedBet
+        data = _checkpoint.pack(height, dgst or bytes(32))
+        data += b''.join(pack_varint(len(b)) + b for b in self.betList_ts(bets))
+        tmp = path + ".tmp"
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)  # never leave a half written checkpoint behind
+
+    def load_checkpoint(self, path):
+        """
+        Restore the bet list from a checkpoint file. The blocks above it are applied
+        by update_chain, and if the blockchain doesn't contain its last block the
+        bet list starts over from empty.
+        """
+        with open(path, 'rb') as f:
+            data = f.read()
+        height, dgst = _checkpoint.unpack_from(data)
+        betList, calls = {}, {}
+        pos = _checkpoint.size
+        while pos < len(data):
+            length, pos = unpack_varint(data, pos)
+            bet = self.bytes_to_bet(data[pos:pos + length])
+            if isinstance(bet, ClosedBet):
+                calls[bet.id] = (betList.pop(bet.id), bet.caller)
+            else:
+                betList[bet.id] = bet
+            pos += length
+        self.checkpoint = (height, dgst, betList, calls)
+        self.restore_checkpoint(height, dgst, betList, calls)
+        print("[INFO] Loaded the bet list checkpoint at height", height)
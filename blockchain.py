@@ -1,24 +1,52 @@
-import binascii
 import hashlib
 import logging
 import struct
 import threading
 import time
-import random
 from typing import List
 
 from bet import BetList
+from blockstore import BlockStore
+from blocktree import BlockTree, MAX_FORK_DEPTH
+from difficulty import header_meets_target, target_work, zeros_to_target
+from miner import MiningPool
 from peer import Peer
-from message import MessageType, block_header_fmt, bet_fmt, hash_header_fmt
+from verifier import DIGEST_SIZE, parse_headers, verify_chain
+from message import MessageType, block_header_fmt, bet_fmt, hash_header_fmt, locator_count_fmt, get_blocks_fmt, \
+    BLOCK_VERSION, block_v2_header_fmt, block_version_fmt, block_size, pack_varint, unpack_varint
 
-# Hoping for 20secs per block with this difficulty level, but depends on host machines
+# Difficulty of the first blocks, then the target is adjusted towards 20secs per block, see difficulty.next_target
 ZEROS_NUM = 22
+# ZEROS_NUM leading zero bits, as a target the header hash is compared against
+TARGET = zeros_to_target(ZEROS_NUM)
+# The easiest target retargeting may reach
+MIN_ZEROS_NUM = 16
+MAX_TARGET = zeros_to_target(MIN_ZEROS_NUM)
 # The hash expected to appear in the first REAL block of the blockchain
 GENESIS_HASH = hashlib.sha256(bytes("0b" + 256 * '0', "ascii")).digest()
+# Most headers sent in one HEADERS message
+MAX_HEADERS = 2000
+# Most bytes of blocks sent in one BLOCKS message
+MAX_BLOCKS_BYTES = 4 * 1024 * 1024
+# A sync whose peer stopped answering for this many seconds can be replaced by another
+SYNC_TIMEOUT = 30
+# Old side branches are dropped from the block tree every this many blocks
+PRUNE_INTERVAL = 100
+# Most bytes the bets of a block may take, see Block.bets_size
+BLOCK_BETS_BYTES = 256 * 1024
+
+_hash_header = struct.Struct(hash_header_fmt)
+_block_version = struct.Struct(block_version_fmt)
+V1_HEADER_SIZE = struct.calcsize(block_header_fmt)
+V2_HEADER_SIZE = struct.calcsize(block_v2_header_fmt)
+BET_SIZE = struct.calcsize(bet_fmt)
 
 class Block:
+    # No per-block __dict__, a chain holds many of these. The header fields are not
+    # kept apart, they are unpacked from the packed header when read.
+    __slots__ = ('_data', '_hash', 'bet_num', 'bets', 'version')
 
-    def __init__(self, prev_hash, timestamp, nonce, bet_num, bets):
+    def __init__(self, prev_hash, timestamp, nonce, bet_num, bets, version=BLOCK_VERSION):
         """
         Structure of a Block.
         @param prev_hash: a 32-byte sha256 hash of the header of previous block
@@ -26,23 +54,162 @@ class Block:
         @param nonce: a number that makes the hash of the current block's header have ZEROS_NUM of zeros in the beginning
         @param bet_num: number of bets held in the block
         @param bets: specific bets, each of type `bytes`
+        @param version: serialization format, 1 for padded string bets, 2 for binary encoded bets (see message.py)
         """
-        self.prev_hash = prev_hash
-        self.timestamp = timestamp
-        self.nonce = nonce
+        self._data = _hash_header.pack(prev_hash, timestamp, nonce)  # starts with the hashed header
+        self._hash = None
         self.bet_num = bet_num
         self.bets = bets
+        self.version = version
+
+    @property
+    def prev_hash(self):
+        return _hash_header.unpack_from(self._data)[0]
+
+    @property
+    def timestamp(self):
+        return _hash_header.unpack_from(self._data)[1]
+
+    @property
+    def nonce(self):
+        return _hash_header.unpack_from(self._data)[2]
+
+    @property
+    def header(self):
+        """
+        The hashed part of the header, packed with hash_header_fmt
+        """
+        return self._data[:_hash_header.size]
+
+    @property
+    def hash(self):
+        """
+        sha256 of the header, computed once
+        """
+        if self._hash is None:
+            self._hash = hashlib.sha256(self.header).digest()
+        return self._hash
+
+    @property
+    def bets_size(self):
+        """
+        Bytes the bets take in the serialized block
+        """
+        if self.version == 1:
+            return self.bet_num * BET_SIZE
+        return sum(len(pack_varint(len(bet))) + len(bet) for bet in self.bets)
+
+
+class BlockView(Block):
+    """
+    A block parsed from a buffer of serialized blocks, of either version.
+    Only the block's own bytes are copied out of the buffer, so a block kept on
+    the chain doesn't hold on to the whole message. The header fields are read
+    from them, the bets are parsed when they are first accessed, and the
+    serialized block is served from them too.
+    """
+    __slots__ = ('_bets',)
+
+    def __init__(self, view, offset=0, dgst=None):
+        """
+        @param view: memoryview of the buffer
+        @param offset: start of the block in the buffer
+        @param dgst: the header hash, if already computed
+        """
+        size = block_size(view, offset)
+        if size is None or offset + size > len(view):
+            raise ValueError("Truncated block at offset %d" % offset)
+        self._data = bytes(view[offset:offset + size])  # the whole serialized block
+        self._hash = dgst
+        self.bet_num, version = _block_version.unpack_from(self._data, _hash_header.size)
+        self.version = version or 1  # version 1 blocks read 0 here
+        self._bets = None
+
+    @property
+    def raw(self):
+        """
+        The serialized block
+        """
+        return self._data
+
+    @property
+    def bets(self):
+        if self._bets is None:
+            raw = self._data
+            if self.version == 1:
+                self._bets = [raw[pos:pos + BET_SIZE]
+                              for pos in range(V1_HEADER_SIZE, V1_HEADER_SIZE + self.bet_num * BET_SIZE, BET_SIZE)]
+            else:
+                bets = []
+                pos = V2_HEADER_SIZE
+                for _ in range(self.bet_num):
+                    length, pos = unpack_varint(raw, pos)
+                    bets.append(raw[pos:pos + length])
+                    pos += length
+                self._bets = bets
+        return self._bets
+
+    @bets.setter
+    def bets(self, bets):
+        self._bets = bets
+
+    @property
+    def bets_size(self):
+        # the rest of the serialized block, without parsing the bets
+        return len(self._data) - (V1_HEADER_SIZE if self.version == 1 else V2_HEADER_SIZE)
+
+
+def parse_blocks(data, offsets, digests=None):
+    """
+    The blocks at the given offsets of data, parsed through one memoryview of it
+    @param offsets: start of each block, e.g. as returned by verifier.parse_headers
+    @param digests: optional concatenated header hashes of the blocks, as returned by verifier.verify_chain
+    """
+    view = memoryview(data)
+    if digests is None:
+        return [BlockView(view, offset) for offset in offsets]
+    return [BlockView(view, offset, digests[i * DIGEST_SIZE:(i + 1) * DIGEST_SIZE])
+            for i, offset in enumerate(offsets)]
 
 
 class Blockchain:
 
-    def __init__(self, peer: Peer, betlist: BetList):
+    def __init__(self, peer: Peer, betlist: BetList, mining_workers=None, store: BlockStore = None):
+        """
+        @param mining_workers: number of processes used for mining, defaults to the number of cores
+        @param store: optional on-disk block store, the chain is loaded from it and every change is written to it
+        """
         self.peer = peer
         self.betlist = betlist
         self.blockchain = []  # type: List[Block]
+        self.heights = {}  # header hash -> height, for every block of self.blockchain
+        self.tree = BlockTree(GENESIS_HASH, TARGET, MAX_TARGET, BLOCK_BETS_BYTES)  # every known block, including competing branches
         self.mining_thread = None # Just a placeholder, will be initialized later
         self.is_mining = False # To identify if mining already begun
         self.stop_mining = False # Used to stop a previously started mining thread
+        self.sync = None # State of the headers-first sync in progress, see headers_handler
+        self.miner = MiningPool(TARGET, mining_workers) # Worker processes searching for nonces
+        self.store = store
+        # Guards the chain, the block tree and the block store, changed by the mining thread and
+        # by handler threads. Reentrant, since add_blocks is also called with it held.
+        self.lock = threading.RLock()
+        if self.store is not None and len(self.store) > 0:
+            self.blockchain = [self._receive_block(self.store.get(h))[1] for h in range(len(self.store))]
+            for height, block in enumerate(self.blockchain):
+                # the stored chain must link up block by block, from the genesis hash
+                try:
+                    linked = block.prev_hash == self.block_hash(height - 1) and self.tree.add(block)
+                    error = "doesn't follow the previous one"
+                except ValueError:
+                    linked, error = False, "fails the consensus checks"
+                if not linked:
+                    print("[ERROR] Stored block at height", height, error + ", dropping the blocks from it on")
+                    del self.blockchain[height:]
+                    self.store.truncate(height)
+                    break
+            self.heights = {block.hash: height for height, block in enumerate(self.blockchain)}
+            print("[INFO] Loaded", len(self.blockchain), "blocks from the block store")
+            self.on_blockchain_changed()
 
     def initial_blockchain_download(self):
         if len(self.peer.peers) == 0:
@@ -50,7 +217,7 @@ class Blockchain:
             self.restart_mining()
         else:
             # otherwise sync from other nodes
-            self.whole_blockchain_request()
+            self.headers_request()
 
     def whole_blockchain_request(self):
         """
@@ -68,40 +235,258 @@ class Blockchain:
         @param data: data received by Peer module
         @param src: which peer sent the data
         """
-        temp_blockchain = []
-        prev_hash = GENESIS_HASH
-        start = struct.calcsize("I")  # message type
-        hdr_size = struct.calcsize(hash_header_fmt)
-        while start < len(data):
-            # Received data contains the whole blockchain, so we loop over it to get all the blocks
-            if not self.verify_header(prev_hash, data[start:start + hdr_size]):
-                print("[IBD] ibd: Header verification failed")
-                break
-            else:
-                n_bytes, block = self._receive_block(data[start:])
-                print("[IBD] Received IBD block of", n_bytes, "bytes")
-                start += n_bytes
-                prev_hash = self.calc_prev_hash(block)
-                temp_blockchain.append(block)
-        if len(self.blockchain) == 0 or len(temp_blockchain) > len(self.blockchain):
-            # Only if the nodes' blockchain is zero length, or the received blockchain is longer
+        # Received data contains the whole blockchain: collect all the headers in one pass,
+        # then hash each of them once for both the PoW check and the next block's prev_hash
+        headers, offsets = parse_headers(data, struct.calcsize("I"))  # skip message type field
+        valid, digests = verify_chain(headers, self.header_targets(GENESIS_HASH, headers), GENESIS_HASH)
+        if valid < len(offsets):
+            print("[IBD] ibd: Header verification failed at height", valid)
+        temp_blockchain = parse_blocks(data, offsets[:valid], digests)
+        print("[IBD] Received", len(temp_blockchain), "valid IBD blocks")
+        if self.add_blocks(temp_blockchain):
+            # Only if the received blockchain has more work than mine
             print("[IBD] Finished IBD from", src)
-            self.blockchain = temp_blockchain
             self.on_blockchain_changed()
             self.restart_mining()
 
-    @staticmethod
-    def _receive_block(data):
-        # This is just a helper function for ibd_response_handler
+    def headers_request(self, target=None):
+        """
+        Ask peers for the headers following the most recent block we have in common,
+        described by a block locator, instead of for their whole blockchain
+        @param target: a single peer to ask, all peers by default
+        """
+        locator = self.block_locator()
+        req = struct.pack('I', MessageType.GET_HEADERS)
+        req += struct.pack(locator_count_fmt, len(locator))
+        req += b''.join(locator)
+        self.peer.send_signed_data(req, target)
+        print("[SYNC] Headers request sent, current height:", len(self.blockchain))
+
+    def get_headers_handler(self, data, src):
+        """
+        Answer a GET_HEADERS request with up to MAX_HEADERS headers following the
+        most recent locator hash found in my blockchain
+        """
+        start = struct.calcsize("I")  # skip message type field
+        count, = struct.unpack_from(locator_count_fmt, data, start)
+        start += struct.calcsize(locator_count_fmt)
+        locator = {data[start + i * DIGEST_SIZE:start + (i + 1) * DIGEST_SIZE] for i in range(count)}
+        common = self.common_length(locator)
+        if common is None:
+            common = 0
+        response = struct.pack("I", MessageType.HEADERS)
+        blocks = self.blockchain[common:common + MAX_HEADERS]
+        for block in blocks:
+            response += struct.pack(block_header_fmt, block.prev_hash, block.timestamp,
+                                    block.nonce, block.bet_num)
+        # answer even with no headers, so that the requester knows it is up to date
+        print("[SYNC] Sending", len(blocks), "headers after height", common, "to", src)
+        self.peer.send_signed_data(response, src)
+
+    def headers_handler(self, data, src):
+        """
+        Verify received headers, and if they lead to a blockchain with more work,
+        start downloading the missing blocks from the sender
+        """
+        start = struct.calcsize("I")  # skip message type field
         hdr_size = struct.calcsize(block_header_fmt)
-        n_bytes = hdr_size
-        prev_hash, timestamp, nonce, bet_num = struct.unpack_from(block_header_fmt, data)
-        bets = []
-        for _ in range(bet_num):
-            bet, = struct.unpack_from(bet_fmt, data[n_bytes:])
-            bets.append(bet)
-            n_bytes += struct.calcsize(bet_fmt)
-        return n_bytes, Block(prev_hash, timestamp, nonce, bet_num, bets)
+        hash_hdr_size = struct.calcsize(hash_header_fmt)
+        count = (len(data) - start) // hdr_size
+        if self.sync is not None and time.time() - self.sync['time'] < SYNC_TIMEOUT:
+            return  # one sync at a time
+        headers = bytearray()
+        for i in range(count):
+            pos = start + i * hdr_size
+            headers += data[pos:pos + hash_hdr_size]
+        common = self.common_length({bytes(headers[:DIGEST_SIZE])}) if count > 0 else None
+        if common is None:
+            self._ensure_mining()
+            return
+        targets = self.header_targets(self.block_hash(common - 1), headers)
+        valid, digests = verify_chain(headers, targets, self.block_hash(common - 1))
+        if valid < count:
+            print("[SYNC] Header verification failed at height", common + valid)
+        # blocks differ in work, so compare the peer's chain by its work, not its length
+        work = self.tree.work(self.block_hash(common - 1)) + sum(target_work(target) for target in targets[:valid])
+        if work <= self.tree.best_work:
+            self._ensure_mining()
+            return
+        print("[SYNC] Peer", src, "has a chain with more work,", valid, "blocks after the fork at height", common)
+        self.sync = {
+            'src': src,
+            'common': common,  # number of blocks shared with the peer's chain
+            'hashes': [digests[i * DIGEST_SIZE:(i + 1) * DIGEST_SIZE] for i in range(valid)],
+            'targets': targets[:valid],
+            'blocks': [],  # downloaded blocks, in order
+            'more': valid == MAX_HEADERS,  # the peer may have even more headers
+            'time': time.time(),
+        }
+        self.blocks_request()
+
+    def blocks_request(self):
+        """
+        Ask the peer we are syncing from for the blocks not downloaded yet
+        """
+        sync = self.sync
+        have = len(sync['blocks'])
+        req = struct.pack("I", MessageType.GET_BLOCKS)
+        req += struct.pack(get_blocks_fmt, sync['hashes'][have], sync['common'] + have,
+                           len(sync['hashes']) - have)
+        self.peer.send_signed_data(req, sync['src'])
+
+    def get_blocks_handler(self, data, src):
+        """
+        Answer a GET_BLOCKS request with as many of the requested blocks as fit in one message
+        """
+        first_hash, height, count = struct.unpack_from(get_blocks_fmt, data, struct.calcsize("I"))
+        if height >= len(self.blockchain) or self.block_hash(height) != first_hash:
+            print("[SYNC] Requested blocks from", src, "are not on my blockchain")
+            return
+        def response():
+            yield struct.pack("I", MessageType.BLOCKS)
+            size = 0
+            for block in self.blockchain[height:height + count]:
+                block_bytes = self.add_block_bytes(block)
+                size += len(block_bytes)
+                if size > MAX_BLOCKS_BYTES and size > len(block_bytes):
+                    break
+                yield block_bytes
+        print("[SYNC] Sending blocks from height", height, "to", src)
+        self.peer.send_signed_stream(response(), src)
+
+    def blocks_handler(self, data, src):
+        """
+        Check a range of downloaded blocks against the headers of the current sync,
+        and switch to the peer's blockchain once all of them arrived
+        """
+        sync = self.sync
+        if sync is None or src != sync['src']:
+            return
+        headers, offsets = parse_headers(data, struct.calcsize("I"))  # skip message type field
+        have = len(sync['blocks'])
+        # ignore any blocks beyond the ones still missing
+        missing = len(sync['hashes']) - have
+        offsets = offsets[:missing]
+        headers = headers[:missing * struct.calcsize(hash_header_fmt)]
+        prev_hash = sync['hashes'][have - 1] if have > 0 else self.block_hash(sync['common'] - 1)
+        valid, digests = verify_chain(headers, sync['targets'][have:have + len(offsets)], prev_hash)
+        for i in range(valid):
+            if digests[i * DIGEST_SIZE:(i + 1) * DIGEST_SIZE] != sync['hashes'][have + i]:
+                valid = i
+                break
+        if valid == 0:
+            print("[SYNC] Received blocks from", src, "don't match their headers")
+            self.sync = None
+            self._ensure_mining()
+            return
+        sync['blocks'].extend(parse_blocks(data, offsets[:valid], digests))
+        sync['time'] = time.time()
+        if len(sync['blocks']) < len(sync['hashes']):
+            self.blocks_request()
+            return
+
+        self.sync = None
+        blocks = sync['blocks']
+        if not self.add_blocks(blocks):
+            # my blockchain changed meanwhile, and has at least as much work
+            print("[SYNC] Blocks from", src, "don't lead to a blockchain with more work")
+            self._ensure_mining()
+            return
+        print("[SYNC] Synced", len(blocks), "blocks from", src)
+        print("[INFO] Current blockchain height:", len(self.blockchain))
+        self.on_blockchain_changed()
+        self.restart_mining()
+        if sync['more']:
+            self.headers_request(src)
+
+    def _ensure_mining(self):
+        if not self.is_mining:
+            self.restart_mining()
+
+    def block_hash(self, height):
+        """
+        Header hash of the block at a height, GENESIS_HASH for height -1
+        """
+        if height < 0:
+            return GENESIS_HASH
+        return self.blockchain[height].hash
+
+    def block_locator(self):
+        """
+        Hashes describing my blockchain: the last 10 blocks, then blocks further
+        and further back with a doubling step, and finally the genesis hash
+        """
+        locator = []
+        height = len(self.blockchain) - 1
+        step = 1
+        while height >= 0:
+            locator.append(self.block_hash(height))
+            if len(locator) >= 10:
+                step *= 2
+            height -= step
+        locator.append(GENESIS_HASH)
+        return locator
+
+    def common_length(self, hashes):
+        """
+        Find the most recent block of my blockchain whose hash is in hashes, with the hash index
+        @param hashes: a set of header hashes
+        @return: number of blocks up to and including that block (0 for the genesis hash),
+                 or None if no hash is known
+        """
+        common = 0 if GENESIS_HASH in hashes else None
+        for dgst in hashes:
+            height = self.heights.get(dgst)
+            if height is not None and (common is None or height + 1 > common):
+                common = height + 1
+        return common
+
+    def add_blocks(self, blocks):
+        """
+        Add verified blocks to the block tree, and if a branch now has more work
+        than my blockchain, switch to it, replacing only the blocks after the fork
+        @return: True if my blockchain changed
+        """
+        with self.lock:
+            for block in blocks:
+                try:
+                    self.tree.add(block)
+                except ValueError:
+                    print("[INFO] A received block fails the consensus checks, dropping the blocks from it on")
+                    break
+            if self.tree.best == self.block_hash(len(self.blockchain) - 1):
+                return False
+            common, branch = self.tree.branch(self.tree.best, self.heights)
+            if common < len(self.blockchain):
+                print("[INFO] Reorganizing", len(self.blockchain) - common, "blocks after height", common)
+            self.replace_blocks(common, branch)
+            self._prune()
+            return True
+
+    def _prune(self):
+        if len(self.blockchain) % PRUNE_INTERVAL == 0:
+            self.tree.prune(len(self.blockchain) - MAX_FORK_DEPTH, self.heights)
+
+    def replace_blocks(self, common, blocks):
+        """
+        Replace every block after the first `common` ones, in memory and in the block store.
+        Must be called with self.lock held.
+        """
+        for block in self.blockchain[common:]:
+            self.heights.pop(block.hash, None)
+        self.blockchain = self.blockchain[:common] + blocks
+        for height, block in enumerate(blocks, common):
+            self.heights[block.hash] = height
+        if self.store is not None:
+            self.store.truncate(common)
+            for block in blocks:
+                self.store.append(self.add_block_bytes(block))
+
+    @staticmethod
+    def _receive_block(data, offset=0):
+        # This is just a helper function for parsing a single block
+        block = BlockView(memoryview(data), offset)
+        return len(block.raw), block
 
     def restart_mining(self):
         """
@@ -110,6 +495,7 @@ class Blockchain:
         """
         if self.is_mining:
             self.stop_mining = True
+            self.miner.stop()
             self.mining_thread.join()
             self.stop_mining = False
             self.mining_thread = threading.Thread(target=self.mining, args=())
@@ -125,83 +511,113 @@ class Blockchain:
         its whole blockchain to that peer
         """
         # assert struct.unpack_from("I", data) == MessageType.IBD_REQUEST
-        response = struct.pack("I", MessageType.IBD_RESPONSE)
-        for block in self.blockchain:
-            response += self.add_block_bytes(block)
+        def response():
+            # blocks are serialized one by one while they are streamed out
+            yield struct.pack("I", MessageType.IBD_RESPONSE)
+            for block in list(self.blockchain):
+                yield self.add_block_bytes(block)
         print("[IBD] Sending whole blockchain to target", src)
-        self.peer.send_signed_data(response, src)
+        self.peer.send_signed_stream(response(), src)
 
     @staticmethod
     def add_block_bytes(block):
         """
         A helper function to transform an Block object to bytes
         """
-        ret = struct.pack(block_header_fmt, block.prev_hash, block.timestamp,
-                          block.nonce, block.bet_num)
-        for i in range(block.bet_num):
-            ret += struct.pack(bet_fmt, block.bets[i])
-        return ret
+        if isinstance(block, BlockView):
+            return block.raw
+        if block.version == 1:
+            ret = struct.pack(block_header_fmt, block.prev_hash, block.timestamp,
+                              block.nonce, block.bet_num)
+            for i in range(block.bet_num):
+                ret += struct.pack(bet_fmt, block.bets[i])
+            return ret
+        body = b''.join(pack_varint(len(bet)) + bet for bet in block.bets)
+        ret = struct.pack(block_v2_header_fmt, block.prev_hash, block.timestamp,
+                          block.nonce, block.bet_num, block.version, len(body))
+        return ret + body
 
     def receive_new_block(self, data, src):
         """
         When a new block computed by peers received, the node checks its validity
-        and add to its blockchain, then restart mining
+        and adds it to the block tree. If it extends my blockchain, or makes a
+        competing branch heavier, the node switches to it and restarts mining.
         """
-        data = data[struct.calcsize("I"):]  # skip message type field
-
-        hash_hdr_size = struct.calcsize(hash_header_fmt)
-        if len(self.blockchain) > 0:
-            prev_hash = self.calc_prev_hash(self.blockchain[-1])
-        else:
-            prev_hash = GENESIS_HASH
-        if not self.verify_header(prev_hash, data[:hash_hdr_size]):
+        start = struct.calcsize("I")  # skip message type field
+        _, new_block = self._receive_block(data, start)
+        if not self.verify_nonce(new_block.header):
             print("[INFO] receive_new_block: Header verification failed")
-            # download peers' block chain to check if there's a longer blockchain fork
-            self.whole_blockchain_request()
-        else:
-            hdr_size = struct.calcsize(block_header_fmt)
-            prev_hash, timestamp, nonce, bet_num = struct.unpack_from(block_header_fmt, data)
-            bets = []
-            for _ in range(bet_num):
-                bet, = struct.unpack_from(bet_fmt, data[hdr_size:])
-                bets.append(bet)
-            new_block = Block(prev_hash, timestamp, nonce, bet_num, bets)
-            self.blockchain.append(new_block)
-            self.on_blockchain_changed()
-            print("[SUCCESS] Received a new valid block from ", src)
-            print("[INFO] Current blockchain height:", len(self.blockchain))
-            print("[INFO] Nonces of last 5 blocks:", [str(block.nonce) for block in self.blockchain[-5:]])
-            self.restart_mining()
+            return
+        with self.lock:
+            if new_block.hash in self.tree:
+                return
+            try:
+                added = self.tree.add(new_block)
+            except ValueError as e:
+                print("[INFO] receive_new_block:", e)
+                return
+            changed = added and self.add_blocks([new_block])
+        if not added:
+            # ask the sender for the headers we miss, the block connects once its parent arrives
+            print("[INFO] receive_new_block: Unknown parent, kept as an orphan")
+            self.headers_request(src)
+            return
+        if not changed:
+            print("[INFO] Received a block of a side branch from", src,
+                  "at height", self.tree.height(new_block.hash))
+            return
+        self.on_blockchain_changed()
+        print("[SUCCESS] Received a new valid block from ", src)
+        print("[INFO] Current blockchain height:", len(self.blockchain))
+        print("[INFO] Nonces of last 5 blocks:", [str(block.nonce) for block in self.blockchain[-5:]])
+        self.restart_mining()
 
     def mining(self):
-        if len(self.blockchain) > 0:
-            from_block = self.blockchain[-1]
-            prev_hash = self.calc_prev_hash(from_block)
-        else:
-            prev_hash = GENESIS_HASH
+        prev_hash = self.block_hash(len(self.blockchain) - 1)
         while not self.stop_mining:
-            # use random nonce to increase the chance of a blockchain fork
-            timestamp = int(time.time())
-            nonce = random.randint(1, 10**9)
-            header = struct.pack(hash_header_fmt, prev_hash, timestamp, nonce)
-            if self.verify_nonce(header):
-                bets = self.betlist.collect_bets(10)
+            # the pool searches the nonce space with all worker processes
+            found = self.miner.search(prev_hash, lambda: self.stop_mining, self.tree.child_target(prev_hash),
+                                      self.tree.median_time(prev_hash) + 1)
+            if found is not None:
+                timestamp, nonce = found
+                bets = self.betlist.collect_bets(BLOCK_BETS_BYTES)
                 bet_num = len(bets)
                 new_block = Block(prev_hash, timestamp, nonce, bet_num, bets)
-                self.blockchain.append(new_block)
+                if not self.append_block(new_block):
+                    # found after my blockchain was replaced, mining restarts on the new tip
+                    print("[INFO] Mined a block on a replaced tip, kept as a side branch")
+                    prev_hash = self.block_hash(len(self.blockchain) - 1)
+                    continue
                 print("[INFO] Mining succeeded. Current blockchain height:", len(self.blockchain))
+                print("[INFO] Hash rate: %.0f hashes/sec" % self.miner.hash_rate)
                 print("[INFO] Nonces of last 5 blocks:", [str(block.nonce) for block in self.blockchain[-5:]])
                 self.broadcast_new_block(new_block)
                 self.on_blockchain_changed()
-                prev_hash = self.calc_prev_hash(new_block)
+                prev_hash = new_block.hash
+
+    def append_block(self, block):
+        """
+        Add a mined block to the end of the chain, and to the block store if there is one.
+        If the chain no longer ends with the block's parent, e.g. it was replaced while
+        mining, the block goes to the block tree as a side branch, see add_blocks.
+        @return: True if the block is now the tip of my blockchain
+        """
+        with self.lock:
+            if block.prev_hash != self.block_hash(len(self.blockchain) - 1):
+                # my blockchain only switches to it if its branch now has more work
+                return self.add_blocks([block])
+            self.heights[block.hash] = len(self.blockchain)
+            self.blockchain.append(block)
+            self.tree.add(block)
+            if self.store is not None:
+                self.store.append(self.add_block_bytes(block))
+            self._prune()
+            return True
 
     @staticmethod
     def calc_prev_hash(block):
-        # Calculate the header hash of a block
-        header = struct.pack(hash_header_fmt, block.prev_hash,
-                             block.timestamp, block.nonce)
-        dgst = hashlib.sha256(header).digest()
-        return dgst
+        # The header hash of a block, cached by the block
+        return block.hash
 
     def broadcast_new_block(self, block):
         request = struct.pack("I", MessageType.NEW_BLOCK)
@@ -219,12 +635,15 @@ class Blockchain:
 
     @staticmethod
     def verify_nonce(block_header):
-        dgst = hashlib.sha256(block_header).digest()
-        bin_str = '{:0256b}'.format(int(binascii.hexlify(dgst), 16))
-        if bin_str[:ZEROS_NUM] == '0' * ZEROS_NUM:
-            return True
-        return False
+        # Cheap check before the block's own target is known: no valid block has an easier one
+        return header_meets_target(block_header, MAX_TARGET)
+
+    def header_targets(self, prev_hash, headers):
+        """
+        Targets of a run of contiguous headers following prev_hash, see BlockTree.targets
+        """
+        return self.tree.targets(prev_hash, [timestamp for _, timestamp, _ in _hash_header.iter_unpack(headers)])
 
     def on_blockchain_changed(self):
-        self.betlist.update_betlist([bet for block in self.blockchain for bet in block.bets])
+        self.betlist.update_chain(self.blockchain)
 
@@ -0,0 +1,170 @@
+import hashlib
+import mmap
+import os
+import struct
+from typing import Dict, List, Tuple
+
+from message import block_size, hash_header_fmt
+
+HASH_HEADER_SIZE = struct.calcsize(hash_header_fmt)
+
+# One index entry per block: offset in the segment file, length and header hash
+index_entry_fmt = '<QI32s'
+_entry = struct.Struct(index_entry_fmt)
+
+SEGMENT_FILE = "blocks.dat"
+INDEX_FILE = "blocks.idx"
+
+
+class BlockStore:
+    """
+    Append-only on-disk store of serialized blocks (the add_block_bytes format, of either version).
+    Blocks are appended to a segment file, and an index file keeps the offset,
+    length and header hash of every block, so the chain can be reopened without
+    parsing it. On open only the tail is checked, to recover from a crash between
+    the two writes of an append.
+    """
+
+    def __init__(self, path, sync=False):
+        """
+        @param path: directory holding the segment and index files, created if missing
+        @param sync: fsync both files after every append
+        """
+        os.makedirs(path, exist_ok=True)
+        self.sync = sync
+        self.data = open(os.path.join(path, SEGMENT_FILE), 'a+b')
+        self.index = open(os.path.join(path, INDEX_FILE), 'a+b')
+        self.view = None  # mmap of the segment file, remapped when it grew
+        self.entries = []  # type: List[Tuple[int, int, bytes]]
+        self.heights = {}  # type: Dict[bytes, int]
+        self._load()
+
+    def _map(self):
+        size = os.fstat(self.data.fileno()).st_size
+        if self.view is not None:
+            if len(self.view) == size:
+                return
+            self.view.close()
+            self.view = None
+        if size > 0:
+            self.view = mmap.mmap(self.data.fileno(), size, access=mmap.ACCESS_READ)
+
+    def _load(self):
+        data_size = os.fstat(self.data.fileno()).st_size
+        index_size = os.fstat(self.index.fileno()).st_size
+        count = index_size // _entry.size
+        self.index.seek(0)
+        raw = self.index.read(count * _entry.size)
+        self.entries = list(_entry.iter_unpack(raw))
+        self._map()
+
+        # Check the tail: drop index entries that point past the data or don't match it
+        while self.entries:
+            offset, length, dgst = self.entries[-1]
+            if offset + length <= data_size and \
+                    self._hash(offset) == dgst and self._block_size(offset) == length:
+                break
+            self.entries.pop()
+        end = self.entries[-1][0] + self.entries[-1][1] if self.entries else 0
+
+        # Blocks written to the data file but not to the index
+        recovered = []
+        while True:
+            length = self._block_size(end) if self.view is not None else None
+            if length is None or end + length > data_size:
+                break
+            recovered.append((end, length, self._hash(end)))
+            end += length
+        self.entries.extend(recovered)
+
+        if end < data_size:
+            self._truncate_data(end)
+        if len(self.entries) * _entry.size != index_size:
+            self._rewrite_index()
+        self.heights = {dgst: height for height, (_, _, dgst) in enumerate(self.entries)}
+
+    def _hash(self, offset):
+        return hashlib.sha256(self.view[offset:offset + HASH_HEADER_SIZE]).digest()
+
+    def _block_size(self, offset):
+        """
+        Size of the block at offset, or None if there is no complete, known-version block there
+        """
+        try:
+            return block_size(self.view, offset)
+        except ValueError:  # garbage, e.g. a torn write
+            return None
+
+    def _truncate_data(self, size):
+        if self.view is not None:
+            self.view.close()
+            self.view = None
+        self.data.truncate(size)
+        self._map()
+
+    def _rewrite_index(self):
+        self.index.truncate(0)
+        self.index.write(b''.join(_entry.pack(*e) for e in self.entries))
+        self.index.flush()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def append(self, block_bytes):
+        """
+        Append one serialized block
+        @return: the height of the block
+        """
+        offset = self.entries[-1][0] + self.entries[-1][1] if self.entries else 0
+        dgst = hashlib.sha256(block_bytes[:HASH_HEADER_SIZE]).digest()
+        entry = (offset, len(block_bytes), dgst)
+        # The data goes first, so the index never points to missing data
+        self.data.write(block_bytes)
+        self.data.flush()
+        self.index.write(_entry.pack(*entry))
+        self.index.flush()
+        if self.sync:
+            os.fsync(self.data.fileno())
+            os.fsync(self.index.fileno())
+        self.entries.append(entry)
+        self.heights[dgst] = len(self.entries) - 1
+        return len(self.entries) - 1
+
+    def get(self, height):
+        """
+        Serialized block at a height, read from the mapped segment file
+        """
+        offset, length, _ = self.entries[height]
+        if self.view is None or len(self.view) < offset + length:
+            self._map()
+        return self.view[offset:offset + length]
+
+    def hash_at(self, height):
+        return self.entries[height][2]
+
+    def height_of(self, dgst):
+        """
+        Height of the block with the given header hash, or None if not stored
+        """
+        return self.heights.get(dgst)
+
+    def truncate(self, height):
+        """
+        Drop every block from the given height on, e.g. when the chain is replaced by a fork
+        """
+        if height >= len(self.entries):
+            return
+        for _, _, dgst in self.entries[height:]:
+            self.heights.pop(dgst, None)
+        end = self.entries[height][0]
+        del self.entries[height:]
+        self._truncate_data(end)
+        self.index.truncate(height * _entry.size)
+        self.index.flush()
+
+    def close(self):
+        if self.view is not None:
+            self.view.close()
+            self.view = None
+        self.data.close()
+        self.index.close()
@@ -0,0 +1,186 @@
+import time
+from collections import OrderedDict, deque
+from typing import Dict, List, Tuple
+
+from difficulty import RETARGET_INTERVAL, next_target, target_work
+
+# Blocks received before their parent, kept until the parent arrives
+MAX_ORPHANS = 64
+# Side branches forking off this many blocks below the tip are dropped
+MAX_FORK_DEPTH = 100
+# A block's timestamp must be above the median timestamp of this many blocks before it
+MEDIAN_TIME_SPAN = 11
+# and at most this many seconds ahead of local time
+MAX_TIME_DRIFT = 2 * 60
+
+
+class BlockTree:
+    """
+    Every known valid block keyed by its hash, the competing branches as well
+    as the current chain, with the height, the target and the cumulative work
+    of the chain ending at each block. The tip of the chain with the most work is `best`.
+    """
+
+    def __init__(self, root_hash, target, max_target=None, max_bets_size=None):
+        """
+        @param root_hash: the prev_hash of the first block of every chain
+        @param target: 32-byte target of the first blocks, until the first retarget, see difficulty.py
+        @param max_target: the easiest target retargeting may reach, defaults to target
+        @param max_bets_size: most bytes the bets of a block may take, no limit if None
+        """
+        self.root_hash = root_hash
+        self.initial_target = target
+        self.max_target = max_target or target
+        self.max_bets_size = max_bets_size
+        self.nodes = {}  # type: Dict[bytes, Tuple[object, int, int, bytes]]  # hash -> (block, height, work, target)
+        self.orphans = OrderedDict()  # hash -> block whose parent is not known yet, oldest first
+        self.best = root_hash
+        self.best_work = 0
+
+    def __contains__(self, dgst):
+        return dgst in self.nodes
+
+    def height(self, dgst):
+        return self.nodes[dgst][1]
+
+    def target(self, dgst):
+        return self.nodes[dgst][3]
+
+    def targets(self, prev_hash, timestamps):
+        """
+        Targets of a run of blocks following prev_hash, see difficulty.next_target
+        @param prev_hash: hash of a known block, or the root hash
+        @param timestamps: timestamps of the blocks of the run
+        @return: list of 32-byte targets, one per block
+        """
+        window = deque(maxlen=RETARGET_INTERVAL)  # timestamps of the last blocks, oldest first
+        dgst = prev_hash
+        while dgst != self.root_hash and len(window) < RETARGET_INTERVAL:
+            block = self.nodes[dgst][0]
+            window.appendleft(block.timestamp)
+            dgst = block.prev_hash
+        if prev_hash == self.root_hash:
+            height, target = 0, self.initial_target
+        else:
+            _, height, _, target = self.nodes[prev_hash]
+            height += 1
+        targets = []
+        for timestamp in timestamps:
+            target = next_target(target, height, window, self.max_target)
+            targets.append(target)
+            window.append(timestamp)
+            height += 1
+        return targets
+
+    def median_time(self, prev_hash):
+        """
+        Median timestamp of the last MEDIAN_TIME_SPAN blocks up to prev_hash, -1 for the root
+        """
+        timestamps = []
+        dgst = prev_hash
+        while dgst != self.root_hash and len(timestamps) < MEDIAN_TIME_SPAN:
+            block = self.nodes[dgst][0]
+            timestamps.append(block.timestamp)
+            dgst = block.prev_hash
+        if not timestamps:
+            return -1
+        return sorted(timestamps)[len(timestamps) // 2]
+
+    def check(self, block):
+        """
+        Consensus checks of a block whose parent is known: its bets fit in
+        max_bets_size, its timestamp is above the median of the blocks before it
+        and not too far in the future, and its hash meets the target its parent's
+        chain sets
+        @return: the block's target
+        @raise ValueError: if a check fails
+        """
+        if self.max_bets_size is not None and block.bets_size > self.max_bets_size:
+            raise ValueError("Block bets take more than %d bytes" % self.max_bets_size)
+        if block.timestamp <= self.median_time(block.prev_hash):
+            raise ValueError("Block timestamp is not above the median of the blocks before it")
+        if block.timestamp > time.time() + MAX_TIME_DRIFT:
+            raise ValueError("Block timestamp is too far in the future")
+        target = self.targets(block.prev_hash, [block.timestamp])[0]
+        if block.hash > target:
+            raise ValueError("Block doesn't meet its target")
+        return target
+
+    def child_target(self, prev_hash):
+        """
+        Target of a new block on top of prev_hash, its own timestamp doesn't count
+        """
+        return self.targets(prev_hash, [0])[0]
+
+    def work(self, dgst):
+        """
+        Cumulative work of the chain ending at a block, 0 for the root
+        """
+        if dgst == self.root_hash:
+            return 0
+        return self.nodes[dgst][2]
+
+    def add(self, block):
+        """
+        Add a block, and every orphan that connects through it. Both are checked
+        with check(), orphans that turn out to fail it are dropped.
+        @return: False if its parent is unknown and it was kept as an orphan
+        @raise ValueError: if the block fails check()
+        """
+        if block.hash in self.nodes:
+            return True
+        if block.timestamp > time.time() + MAX_TIME_DRIFT:
+            raise ValueError("Block timestamp is too far in the future")
+        if block.prev_hash != self.root_hash and block.prev_hash not in self.nodes:
+            self.orphans[block.hash] = block
+            if len(self.orphans) > MAX_ORPHANS:
+                self.orphans.popitem(last=False)
+            return False
+        self.check(block)
+        pending = [block]
+        while pending:
+            block = pending.pop()
+            self.orphans.pop(block.hash, None)
+            try:
+                target = self.check(block)
+            except ValueError:
+                continue
+            work = self.work(block.prev_hash) + target_work(target)
+            height = 0 if block.prev_hash == self.root_hash else self.nodes[block.prev_hash][1] + 1
+            self.nodes[block.hash] = (block, height, work, target)
+            # on equal work the branch seen first stays the best
+            if work > self.best_work:
+                self.best, self.best_work = block.hash, work
+            if self.orphans:
+                pending.extend(o for o in self.orphans.values() if o.prev_hash == block.hash)
+        return True
+
+    def branch(self, tip, chain_heights):
+        """
+        The part of the branch ending at tip that is not on the current chain
+        @param tip: hash of the last block of the branch
+        @param chain_heights: hash -> height of the blocks of the current chain
+        @return: (common, blocks), the number of blocks the branch shares with the
+                 current chain and the branch's blocks after those, in order
+        """
+        blocks = []  # type: List[object]
+        dgst = tip
+        while dgst != self.root_hash and dgst not in chain_heights:
+            block = self.nodes[dgst][0]
+            blocks.append(block)
+            dgst = block.prev_hash
+        blocks.reverse()
+        common = 0 if dgst == self.root_hash else chain_heights[dgst] + 1
+        return common, blocks
+
+    def prune(self, min_height, chain_heights):
+        """
+        Drop the blocks below min_height that are not on the current chain,
+        and the rest of their branches
+        """
+        side = [(height, dgst, block) for dgst, (block, height, _, _) in self.nodes.items()
+                if dgst not in chain_heights]
+        # parents first, so a dropped block's children see it is gone
+        for height, dgst, block in sorted(side, key=lambda node: node[0]):
+            if height < min_height or (block.prev_hash != self.root_hash and block.prev_hash not in self.nodes):
+                del self.nodes[dgst]
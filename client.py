@@ -8,44 +8,54 @@ from blockchain import Blockchain
 from message import MessageType
 from peer import Peer
 from bet import BetList
+from blockstore import BlockStore
 import gui
 
-peer = Peer(sys.argv[1])
-
-print("Threading Peer...")
-peer_run_thread = threading.Thread(target=peer.run, args=())
-peer_run_thread.start()
-
-# Wait for peer to sync its peer list
-time.sleep(3)
-
-betlist = BetList(peer)
-chain = Blockchain(peer, betlist)
-
-peer.register_msg_handler(MessageType.IBD_RESPONSE, chain.ibd_response_handler)
-peer.register_msg_handler(MessageType.IBD_REQUEST, chain.push_my_blockchain)
-peer.register_msg_handler(MessageType.NEW_BLOCK, chain.receive_new_block)
-peer.register_msg_handler(MessageType.NEW_BET, betlist.receive_bets)
-
-chain.initial_blockchain_download()
-
-gui.main(betlist)
-
-## Set up the CTRL+C handler
-def sigint_handler(s, t):
-    peer.interrupt_handler()
-    peer_run_thread.join()
-    peer.peerfd.close()
-    chain.stop_mining = True
-    chain.mining_thread.join()
-    # exit(0)
-
-signal(SIGINT, sigint_handler)
-
-# peer_run_thread.join()
-# while 1:
-#     line = input('\r..> ')
-#     print("You just put a bet:", line)
-#     sys.stdout.flush()
-#     betlist.place_bet(socket.gethostname(), line, "Yes!", "50", time.time() + 120)
-#     print(betlist.betList)
+# The mining and verifier pools start worker processes, which import this module
+# again under the spawn and forkserver start methods, so the node only starts here
+if __name__ == "__main__":
+    peer = Peer(sys.argv[1], key_cache="peer_keys.json")
+
+    print("Threading Peer...")
+    peer_run_thread = threading.Thread(target=peer.run, args=())
+    peer_run_thread.start()
+
+    # Wait for peer to sync its peer list
+    time.sleep(3)
+
+    betlist = BetList(peer, checkpoint="blockdata/betlist.ckpt")
+    chain = Blockchain(peer, betlist, store=BlockStore("blockdata"))
+
+    peer.register_msg_handler(MessageType.IBD_RESPONSE, chain.ibd_response_handler)
+    peer.register_msg_handler(MessageType.IBD_REQUEST, chain.push_my_blockchain)
+    peer.register_msg_handler(MessageType.NEW_BLOCK, chain.receive_new_block)
+    peer.register_msg_handler(MessageType.NEW_BET, betlist.receive_bets)
+    peer.register_msg_handler(MessageType.GET_HEADERS, chain.get_headers_handler)
+    peer.register_msg_handler(MessageType.HEADERS, chain.headers_handler)
+    peer.register_msg_handler(MessageType.GET_BLOCKS, chain.get_blocks_handler)
+    peer.register_msg_handler(MessageType.BLOCKS, chain.blocks_handler)
+
+    chain.initial_blockchain_download()
+
+    gui.main(betlist)
+
+    ## Set up the CTRL+C handler
+    def sigint_handler(s, t):
+        peer.interrupt_handler()
+        peer_run_thread.join()
+        peer.peerfd.close()
+        chain.stop_mining = True
+        chain.mining_thread.join()
+        chain.miner.close()
+        chain.store.close()
+        # exit(0)
+
+    signal(SIGINT, sigint_handler)
+
+    # peer_run_thread.join()
+    # while 1:
+    #     line = input('\r..> ')
+    #     print("You just put a bet:", line)
+    #     sys.stdout.flush()
+    #     betlist.place_bet(socket.gethostname(), line, "Yes!", "50", time.time() + 120)
+    #     print(betlist.betList)
@@ -0,0 +1,71 @@
+import hashlib
+
+# A target is the largest header hash, read as a 256-bit big-endian number, that
+# counts as a valid proof of work. Targets are kept as 32 big-endian bytes, so a
+# digest can be checked with one bytes comparison and no int or string conversion.
+TARGET_SIZE = 32
+
+# Seconds hoped for between blocks
+BLOCK_TIME = 20
+# The target is adjusted every this many blocks, from the timestamps of the last ones
+RETARGET_INTERVAL = 20
+# Most the target moves in one adjustment, either way
+MAX_ADJUST = 4
+
+
+def zeros_to_target(zeros):
+    """
+    Target equivalent to requiring `zeros` leading zero bits in the hash
+    @param zeros: number of leading zero bits, 0 <= zeros <= 256
+    """
+    return ((1 << (256 - zeros)) - 1).to_bytes(TARGET_SIZE, 'big')
+
+
+def target_to_int(target):
+    return int.from_bytes(target, 'big')
+
+
+def int_to_target(value):
+    return value.to_bytes(TARGET_SIZE, 'big')
+
+
+def next_target(target, height, timestamps, max_target):
+    """
+    Target of the block at a height. Every RETARGET_INTERVAL blocks the target is
+    scaled by how long the last interval took against BLOCK_TIME per block, by at
+    most MAX_ADJUST either way, so every node computes the same full 256-bit target.
+    @param target: target of the block before it, or the initial target at height 0
+    @param timestamps: timestamps of the (up to) RETARGET_INTERVAL blocks before it, oldest first
+    @param max_target: the easiest target allowed
+    """
+    if height == 0 or height % RETARGET_INTERVAL != 0:
+        return target
+    expected = BLOCK_TIME * (len(timestamps) - 1)
+    span = min(max(timestamps[-1] - timestamps[0], expected // MAX_ADJUST), expected * MAX_ADJUST)
+    value = target_to_int(target) * span // expected
+    return int_to_target(max(1, min(value, target_to_int(max_target))))
+
+
+def target_work(target):
+    """
+    Expected number of hashes needed to find a header hash that meets target,
+    the work a block adds to its chain
+    """
+    return (1 << 256) // (target_to_int(target) + 1)
+
+
+def digest_meets_target(dgst, target):
+    """
+    Check an already computed sha256 digest against a target.
+    Equal-length bytes compare like big-endian numbers.
+    """
+    return dgst <= target
+
+
+def header_meets_target(block_header, target):
+    """
+    Hash a packed header and check it against a target
+    @param block_header: header packed with hash_header_fmt
+    @param target: 32-byte target, see zeros_to_target
+    """
+    return hashlib.sha256(block_header).digest() <= target
@@ -17,6 +17,9 @@ except socket.error as e:
 	print(f"[ERR] Failed to get host by name {e}")
 	exit(0)
 
+# Bets loaded into the bet list at a time, "More" loads the next page
+PAGE_SIZE = 100
+
 
 def build_layout():
 
@@ -26,7 +29,8 @@ def build_layout():
 
 	# --------------------------------- Define Layout ---------------------------------
 	left_col = [[sg.Button('Callable Bets', key="-CALLABLE_BETS-"),sg.Button('My Bets', key="-MY_BETS-"), sg.Button('Refresh', key="-REFRESH-")],
-				[sg.Listbox(values=[], enable_events=True, size=(40,20), key='-BET_LIST-')]
+				[sg.Listbox(values=[], enable_events=True, size=(40,20), key='-BET_LIST-')],
+				[sg.Button('More', key="-MORE-")]
 				]
 
 	right_col = [	[sg.Text('Bet Event', **td, **th )],
@@ -61,6 +65,12 @@ def build_layout():
 
 	return window
 
+def load_bets(betlist, is_on_callable, offset=0):
+	## One page of callable bets, or of my bets
+	if is_on_callable:
+		return betlist.get_open_bets(offset, PAGE_SIZE)
+	return betlist.get_user_bets(host_name, offset, PAGE_SIZE)
+
 def event_loop(window, betlist):
 
 	# ----- Run the Event Loop -----
@@ -106,7 +116,7 @@ def event_loop(window, betlist):
 		if event == "-CALLABLE_BETS-":
 			window["-ACCEPT_BTN-"].update(disabled = False)
 			is_on_callable = True
-			bet_dict = betlist.get_open_bets()
+			bet_dict = load_bets(betlist, is_on_callable)
 			open_best_list = [x["event"] for x in bet_dict]
 			window['-BET_LIST-'].update(open_best_list)
 
@@ -114,15 +124,15 @@ def event_loop(window, betlist):
 		elif event == "-MY_BETS-":
 			window["-ACCEPT_BTN-"].update(disabled = True)
 			is_on_callable = False
-			bet_dict = betlist.get_user_bets(host_name)
+			bet_dict = load_bets(betlist, is_on_callable)
 			pending_best_list = [x["event"] for x in bet_dict]
 			window['-BET_LIST-'].update(pending_best_list)
 
 		# Item in bet list clicked
 		elif event == '-BET_LIST-':    # A bet was chosen from the bet box
-			candidates = [x for x in bet_dict if x["event"] == values["-BET_LIST-"][0]]
-			if candidates:
-				selected_bet = candidates[0]
+			indexes = window['-BET_LIST-'].get_indexes()
+			if indexes and indexes[0] < len(bet_dict):
+				selected_bet = bet_dict[indexes[0]]
 				window["-BET_EVENT-"].update(selected_bet["event"])
 				window["-BET_VALUE-"].update(selected_bet["amount"])
 
@@ -157,21 +167,19 @@ def event_loop(window, betlist):
 				threading.Thread(target=betlist.call_bet,
 								 args=(selected_bet["uuid"], host_name)
 								 ).start()
-				bet_dict = betlist.get_open_bets()
+				bet_dict = load_bets(betlist, is_on_callable)
 				open_best_list = [x["event"] for x in bet_dict]
 				window['-BET_LIST-'].update(open_best_list)
 		
 		elif event == "-REFRESH-":
-			if is_on_callable:
-				# Refresh callable list
-				bet_dict = betlist.get_open_bets()
-				open_best_list = [x["event"] for x in bet_dict]
-				window['-BET_LIST-'].update(open_best_list)
-			else:
-				# Refresh my bets list
-				bet_dict = betlist.get_user_bets(host_name)
-				pending_best_list = [x["event"] for x in bet_dict]
-				window['-BET_LIST-'].update(pending_best_list)
+			# Refresh callable list or my bets list
+			bet_dict = load_bets(betlist, is_on_callable)
+			window['-BET_LIST-'].update([x["event"] for x in bet_dict])
+
+		# More clicked, append the next page
+		elif event == "-MORE-":
+			bet_dict = bet_dict + load_bets(betlist, is_on_callable, len(bet_dict))
+			window['-BET_LIST-'].update([x["event"] for x in bet_dict])
 
 
 
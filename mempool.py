@@ -0,0 +1,128 @@
+import heapq
+import itertools
+from typing import Dict, List, Tuple
+
+from message import pack_varint
+
+# Bounds of the pending bets, beyond them the lowest priority bets are dropped
+MAX_POOL_BETS = 10000
+MAX_POOL_BYTES = 4 * 1024 * 1024
+
+
+class Mempool:
+    """
+    Bets waiting to be put on a block, keyed so the same bet is only kept once.
+    Bets are ordered by amount, larger first, then by age, older first. The pool
+    is bounded by count and bytes. When it is full, a bet is only accepted if it
+    ranks above the lowest ranked bet, which is then dropped.
+    """
+
+    def __init__(self, max_count=MAX_POOL_BETS, max_bytes=MAX_POOL_BYTES):
+        """
+        @param max_count: most bets kept
+        @param max_bytes: most bytes of encoded bets kept
+        """
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.entries = {}  # type: Dict[object, Tuple[float, int, object, bytes]]  # key -> (amount, seq, bet, data)
+        self.size = 0  # bytes of the encoded bets
+        # Heaps of (rank, seq, key), best and worst first. Entries of bets that left
+        # the pool stay until they come up, they are told apart by their seq.
+        self.best = []  # type: List[Tuple[float, int, object]]
+        self.worst = []  # type: List[Tuple[float, int, object]]
+        self.seq = itertools.count()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        return entry[2] if entry is not None else None
+
+    def add(self, key, bet, data, amount):
+        """
+        @param key: identity of the bet, a bet with a key already pending is a duplicate
+        @param data: the encoded bet
+        @param amount: the amount the bet is ranked by
+        @return: False if it is a duplicate or ranks too low for a full pool
+        """
+        if key in self.entries or len(data) > self.max_bytes:
+            return False
+        seq = next(self.seq)
+        while len(self.entries) >= self.max_count or self.size + len(data) > self.max_bytes:
+            # a newer bet of the same amount ranks lower, so it doesn't push out an older one
+            worst = self._peek(self.worst)
+            if (amount, -seq) < (worst[0], worst[1]):
+                return False
+            self.remove(worst[2])
+        if len(self.best) > 2 * len(self.entries) + 64:
+            self._compact()
+        self.entries[key] = (amount, seq, bet, data)
+        self.size += len(data)
+        heapq.heappush(self.best, (-amount, seq, key))
+        heapq.heappush(self.worst, (amount, -seq, key))
+        return True
+
+    def remove(self, key):
+        """
+        Drop a pending bet, e.g. when a block confirmed it
+        @return: the bet, or None if it wasn't pending
+        """
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return None
+        self.size -= len(entry[3])
+        return entry[2]
+
+    def _compact(self):
+        # drop the heap entries of bets that left the pool
+        self.best = [(-amount, seq, key) for key, (amount, seq, _, _) in self.entries.items()]
+        self.worst = [(amount, -seq, key) for key, (amount, seq, _, _) in self.entries.items()]
+        heapq.heapify(self.best)
+        heapq.heapify(self.worst)
+
+    def _peek(self, heap):
+        # first heap entry of a bet still pending, or None
+        while heap:
+            _, seq, key = heap[0]
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] == abs(seq):
+                return heap[0]
+            heapq.heappop(heap)
+        return None
+
+    def select(self, count, accept, max_bytes=None):
+        """
+        The best pending bets, without removing them
+        @param count: most bets returned, None for no limit
+        @param accept: called with (key, bet) in rank order, returns True to take the
+                       bet, False to leave it pending, None to drop it from the pool
+        @param max_bytes: most bytes the returned bets take in a block, each with its varint length,
+                          bets that don't fit stay pending
+        @return: list of (key, bet, data)
+        """
+        taken = []  # type: List[Tuple[object, object, bytes]]
+        popped = []
+        size = 0
+        while (count is None or len(taken) < count) and self._peek(self.best) is not None:
+            item = heapq.heappop(self.best)
+            key = item[2]
+            data = self.entries[key][3]
+            cost = len(pack_varint(len(data))) + len(data)
+            if max_bytes is not None and size + cost > max_bytes:
+                popped.append(item)
+                continue
+            verdict = accept(key, self.entries[key][2])
+            if verdict:
+                taken.append((key, self.entries[key][2], data))
+                size += cost
+            elif verdict is None:
+                self.remove(key)
+            if key in self.entries:
+                popped.append(item)
+        for item in popped:
+            heapq.heappush(self.best, item)
+        return taken
@@ -1,4 +1,5 @@
 import enum
+import struct
 
 bet_fmt = "1000s"
 block_header_fmt = '<32sIII'
@@ -11,6 +12,94 @@ block_header_fmt = '<32sIII'
 # <32sIII = little endian | byte[32] | unsigned int | unsigned int | unsigned int
 hash_header_fmt = '<32sII'
 
+# Version 2 blocks: the hashed header, H : number of bets, H : version, I : length of the bets,
+# followed by the bets, each a varint length and a binary encoded bet (see bet.py).
+# Version 1 blocks are block_header_fmt followed by bet_num bets of bet_fmt. Their bet_num is
+# below 2^16, so the version field, the high half of their 32-bit bet_num, reads 0.
+BLOCK_VERSION = 2
+block_v2_header_fmt = '<32sIIHHI'
+# bet_num and version, right after the hashed header in both versions
+block_version_fmt = '<HH'
+
+# GET_HEADERS: I : number of locator hashes, followed by that many 32-byte hashes
+locator_count_fmt = '<I'
+# GET_BLOCKS: 32s : hash of the first block wanted, I : its height, I : number of blocks wanted
+get_blocks_fmt = '<32sII'
+# BATCH: a list of I : message length, followed by the message (with its own type field)
+batch_entry_fmt = '<I'
+# Heartbeat datagram from a peer to the tracker: d : time sent, followed by the peer's signature of it
+heartbeat_fmt = '<d'
+# Peer list request: Q : session of the tracker, Q : epoch of the peer's list (0, 0 for the full list)
+# The reply is text lines: "session epoch kind", the number of entries, then one entry per line,
+# '+host' for an added or '-host' for a removed peer. Kind D is the changes since the requested
+# epoch, kind F is the full list, as added entries, to replace the peer's list.
+peer_list_request_fmt = '<QQ'
+
+# Tracker requests and responses, any number of them over one connection to the tracker port.
+# I : request id, echoed in the response, B : TrackerRequest / TrackerStatus, I : payload length
+tracker_request_fmt = '<IBI'
+tracker_response_fmt = '<IBI'
+# BOOTSTRAP response: I : length of the peer list, the full peer list, I : number of keys,
+# then for each key, H : host length, I : key length, the host and the PEM key
+tracker_count_fmt = '<I'
+tracker_key_fmt = '<HI'
+
+_hash_header_size = struct.calcsize(hash_header_fmt)
+_v1_header_size = struct.calcsize(block_header_fmt)
+_v2_header_size = struct.calcsize(block_v2_header_fmt)
+_bet_size = struct.calcsize(bet_fmt)
+_block_version = struct.Struct(block_version_fmt)
+_body_len = struct.Struct('<I')
+
+
+def pack_varint(value):
+    """
+    Unsigned LEB128: 7 bits per byte, lowest first, the high bit set on all but the last byte
+    """
+    out = bytearray()
+    while value > 0x7f:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def unpack_varint(data, pos=0):
+    """
+    @return: (value, offset right after the varint)
+    """
+    value = 0
+    shift = 0
+    while True:
+        if pos >= len(data):
+            raise ValueError("Truncated varint")
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+        if shift > 63:
+            raise ValueError("Varint too long")
+
+
+def block_size(data, pos=0):
+    """
+    Size of the serialized block, of either version, at data[pos:]
+    @return: the size, or None if data ends within the block's header
+    """
+    if pos + _v1_header_size > len(data):
+        return None
+    bet_num, version = _block_version.unpack_from(data, pos + _hash_header_size)
+    if version == 0:
+        return _v1_header_size + bet_num * _bet_size
+    if version == BLOCK_VERSION:
+        if pos + _v2_header_size > len(data):
+            return None
+        body_len, = _body_len.unpack_from(data, pos + _v2_header_size - _body_len.size)
+        return _v2_header_size + body_len
+    raise ValueError("Unknown block version %d" % version)
+
 
 class MessageType(enum.IntEnum):
     IBD_REQUEST = 1 # Request to download whole blockchain from peers
@@ -18,3 +107,25 @@ class MessageType(enum.IntEnum):
     NEW_BLOCK = 3 # A new valid block found
 
     NEW_BET = 4 # Request to place a new open bet
+
+    GET_HEADERS = 5 # Request headers following the first known hash of a block locator
+    HEADERS = 6 # Response of consecutive block headers (block_header_fmt each)
+    GET_BLOCKS = 7 # Request a range of blocks, starting at a given hash
+    BLOCKS = 8 # Response of a range of consecutive blocks
+
+    BATCH = 9 # Several small messages signed and sent together
+
+
+class TrackerRequest(enum.IntEnum):
+    REGISTER = 1 # Register with the PEM public key in the payload
+    GET_KEY = 2 # Public key of the host in the payload
+    GET_PEERS = 3 # Peer list, the payload is packed with peer_list_request_fmt
+    BOOTSTRAP = 4 # REGISTER, then the full peer list and the keys of all peers, the payload is the PEM public key
+
+
+class TrackerStatus(enum.IntEnum):
+    OK = 0
+    REJECTED = 1 # Invalid public key
+    DENIED = 2 # The requesting host is not registered
+    UNKNOWN = 3 # No key for the requested host
+    BAD_REQUEST = 4 # Unknown request type or malformed payload
@@ -0,0 +1,181 @@
+import hashlib
+import multiprocessing
+import os
+import queue
+import random
+import struct
+import time
+
+from message import hash_header_fmt
+
+# Size of the nonce field in hash_header_fmt (unsigned int, 32 bit)
+NONCE_SPACE = 2 ** 32
+# Number of nonces tried with one timestamp, before checking whether the job is still current
+BATCH_SIZE = 4096
+
+HEADER_SIZE = struct.calcsize(hash_header_fmt)
+# Offsets of the fields that change while mining, see hash_header_fmt
+TIMESTAMP_OFFSET = 32
+NONCE_OFFSET = 36
+_field = struct.Struct('<I')
+
+
+class HeaderSearch:
+    """
+    Sequential nonce search on top of one prev_hash.
+    The header is packed once into a preallocated buffer and only the
+    timestamp (once per batch) and nonce (per attempt) are written in place.
+    The 40-byte header fits in one sha256 block, so each attempt hashes the
+    whole buffer, there is no midstate to reuse.
+    """
+
+    def __init__(self, prev_hash, target, min_timestamp=0):
+        """
+        @param prev_hash: the 32-byte hash of the previous block header
+        @param target: 32-byte target a valid header hash must not exceed, see difficulty.py
+        @param min_timestamp: the earliest timestamp the block may have
+        """
+        self.target = target
+        self.min_timestamp = min_timestamp
+        self.header = bytearray(HEADER_SIZE)
+        struct.pack_into(hash_header_fmt, self.header, 0, prev_hash, 0, 0)
+        self.hashes = 0  # number of headers hashed so far
+
+    def search_batch(self, first_nonce, count):
+        """
+        Try `count` consecutive nonces starting at first_nonce with a fresh timestamp
+        @return: (timestamp, nonce) of a valid header, or None
+        """
+        header = self.header
+        sha256 = hashlib.sha256
+        pack_into = _field.pack_into
+        target = self.target
+        timestamp = max(int(time.time()), self.min_timestamp)
+        pack_into(header, TIMESTAMP_OFFSET, timestamp)
+        for nonce in range(first_nonce, first_nonce + count):
+            pack_into(header, NONCE_OFFSET, nonce)
+            if sha256(header).digest() <= target:
+                self.hashes += nonce - first_nonce + 1
+                return timestamp, nonce
+        self.hashes += count
+        return None
+
+
+def _mine_worker(index, workers, target, jobs, results, generation, hashes):
+    """
+    Body of a mining process. Waits for jobs of the form (gen, prev_hash, offset, target, min_timestamp)
+    and searches its own slice of the nonce space in batches until a valid nonce
+    is found or the pool's generation counter moves on (a new job, or mining was stopped).
+    """
+    slice_size = NONCE_SPACE // workers
+    slice_start = index * slice_size
+    slice_end = slice_start + slice_size
+    while True:
+        job = jobs.get()
+        if job is None:
+            return
+        gen, prev_hash, offset, job_target, min_timestamp = job
+        if generation.value != gen:
+            continue  # a stale job, the pool has already moved on
+        search = HeaderSearch(prev_hash, job_target or target, min_timestamp)
+        nonce = slice_start + offset % slice_size
+        while generation.value == gen:
+            count = min(BATCH_SIZE, slice_end - nonce)
+            tried = search.hashes
+            found = search.search_batch(nonce, count)
+            with hashes.get_lock():
+                hashes.value += search.hashes - tried
+            if found is not None:
+                results.put((gen,) + found)
+                break
+            nonce += count
+            if nonce == slice_end:
+                nonce = slice_start  # slice exhausted, go around again with newer timestamps
+
+
+class MiningPool:
+    """
+    A pool of worker processes that search the nonce space of a block header
+    in parallel, so mining is not limited to one core by the GIL.
+    """
+
+    def __init__(self, target, workers=None):
+        """
+        @param target: 32-byte target a valid header hash must not exceed, see difficulty.py
+        @param workers: number of mining processes, defaults to the number of cores
+        """
+        self.target = target
+        self.workers = workers or os.cpu_count() or 1
+        # Bumped for every new search and on stop, workers drop any job with an older value
+        self.generation = multiprocessing.Value('Q', 0)
+        # Total number of headers hashed by all workers
+        self.hashes = multiprocessing.Value('Q', 0)
+        self.hash_rate = 0.0  # hashes/sec of the last search
+        self.results = multiprocessing.Queue()
+        self.jobs = []
+        self.processes = []
+        for i in range(self.workers):
+            jobs = multiprocessing.Queue()
+            p = multiprocessing.Process(target=_mine_worker,
+                                        args=(i, self.workers, self.target, jobs,
+                                              self.results, self.generation, self.hashes),
+                                        daemon=True)
+            p.start()
+            self.jobs.append(jobs)
+            self.processes.append(p)
+
+    def _next_generation(self):
+        with self.generation.get_lock():
+            self.generation.value += 1
+            return self.generation.value
+
+    def search(self, prev_hash, should_stop=None, target=None, min_timestamp=0):
+        """
+        Search for a nonce on top of prev_hash with every worker.
+        Blocks until a valid header is found or stop() is called.
+        @param prev_hash: the 32-byte hash of the previous block header
+        @param should_stop: optional callable, polled while waiting, that ends the search when it returns True
+        @param target: target of this block, defaults to the pool's target
+        @param min_timestamp: the earliest timestamp the block may have
+        @return: (timestamp, nonce) of the valid header, or None if stopped
+        """
+        gen = self._next_generation()
+        start_time = time.time()
+        start_hashes = self.hashes.value
+        # Random offset, so that different nodes don't search the same nonces
+        offset = random.randint(0, NONCE_SPACE - 1)
+        for jobs in self.jobs:
+            jobs.put((gen, prev_hash, offset, target, min_timestamp))
+        while self.generation.value == gen:
+            if should_stop is not None and should_stop():
+                self._next_generation()
+                break
+            try:
+                found_gen, timestamp, nonce = self.results.get(timeout=0.2)
+            except queue.Empty:
+                continue
+            if found_gen != gen:
+                continue  # a late result from an earlier search
+            self._next_generation()  # stop the other workers
+            self._update_hash_rate(start_time, start_hashes)
+            return timestamp, nonce
+        self._update_hash_rate(start_time, start_hashes)
+        return None
+
+    def _update_hash_rate(self, start_time, start_hashes):
+        elapsed = time.time() - start_time
+        if elapsed > 0:
+            self.hash_rate = (self.hashes.value - start_hashes) / elapsed
+
+    def stop(self):
+        """
+        Stop the current search; search() returns None shortly after
+        """
+        self._next_generation()
+
+    def close(self):
+        self.stop()
+        for jobs in self.jobs:
+            jobs.put(None)
+        for p in self.processes:
+            p.join()
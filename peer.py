@@ -1,5 +1,11 @@
+import asyncio
 import socket
 import threading
+import traceback
+import queue
+import json
+import os
+from collections import OrderedDict, deque
 import sys
 import select
 from signal import signal, SIGINT
@@ -8,28 +14,706 @@ import struct
 import time
 from Crypto.PublicKey import RSA
 from Crypto.Hash import SHA256
+from message import MessageType, batch_entry_fmt, heartbeat_fmt, peer_list_request_fmt, \
+	tracker_request_fmt, tracker_response_fmt, tracker_count_fmt, tracker_key_fmt, \
+	TrackerRequest, TrackerStatus
+
+""" Message framing, all fields little endian.
+	legacy:    H data_len | H sig_len | data | sig  (both lengths 0 is a ping)
+	version 2: H FRAME_MAGIC | H sig_len | B version | B flags | body | sig
+		body is Q data_len | data, or when FLAG_CHUNKED is set, a list of
+		I chunk_len | chunk ended by a chunk of length 0, so that data can be
+		streamed without knowing its length in advance
+	A data_len of FRAME_MAGIC with a nonzero sig_len marks a version 2 frame.
+	No legacy frame has it: legacy data always starts with its message type,
+	and any data_len from 1 to 0xFFFF is a legacy frame of that length.
+"""
+FRAME_MAGIC = 0
+FRAME_VERSION = 2
+FLAG_CHUNKED = 0x01
+
+frame_fmt = '<HHBB'
+legacy_frame_fmt = '<HH'
+
+## Streamed data is sent in chunks of about this size
+STREAM_CHUNK_SIZE = 64 * 1024
+
+## Messages larger than this are refused
+MAX_MESSAGE_SIZE = 256 * 1024 * 1024
+
+## Messages waiting for one peer, new ones are dropped beyond this
+MAX_QUEUED_MESSAGES = 1000
+
+## Pieces of a stream buffered for one peer, the producer waits for the slowest peer
+STREAM_QUEUE_SIZE = 16
+
+## Attempts to deliver a message to a peer before it is dropped
+SEND_ATTEMPTS = 3
+
+## Bounds of the reconnect backoff, in seconds
+MIN_BACKOFF = 0.5
+MAX_BACKOFF = 30
+
+## Timeout of connect and of each write on a peer connection, in seconds
+SEND_TIMEOUT = 10
+
+## Public keys fetched from the tracker are trusted for this many seconds
+KEY_TTL = 600
 
-""" Read from the socket until the value specified by 'u' is received
-	include is used to specify if the trailing 'u' data is to be included or excluded
-	from the final returned data
+## Most public keys kept in memory, the least recently used go first
+KEY_CACHE_SIZE = 1024
+
+## Batched messages wait at most this many seconds before they are sent
+BATCH_DELAY = 0.05
+
+## A batch is sent right away once it holds this many messages
+MAX_BATCH = 64
+
+## Seconds between two heartbeats to the tracker, which keeps a peer
+## registered for a while after each one without pinging it
+HEARTBEAT_INTERVAL = 20
+
+## Received messages waiting to be handled, per priority
+MAX_INBOUND_MESSAGES = 1000
+
+## Order in which received messages are handled, lowest first. Types that are
+## not listed, and batches (which carry bets), get the lowest priority.
+MESSAGE_PRIORITY = {
+	MessageType.NEW_BLOCK: 0,
+	MessageType.IBD_REQUEST: 1,
+	MessageType.IBD_RESPONSE: 1,
+	MessageType.GET_HEADERS: 1,
+	MessageType.HEADERS: 1,
+	MessageType.GET_BLOCKS: 1,
+	MessageType.BLOCKS: 1,
+	MessageType.NEW_BET: 2,
+	MessageType.BATCH: 2,
+}
+
+""" The type field of a message, or None if it is too short to have one
 """
-def readuntil(s, u, include=False):
-	data = b''
+def message_type(data):
+	if len(data) < struct.calcsize('I'):
+		return None
+
+	return struct.unpack_from('I', data)[0]
+
+class MessageQueue:
+	""" Bounded queue of received messages, taken highest priority first and
+		in arrival order within a priority. Each priority has its own capacity,
+		so a flood of bets can't keep a new block waiting or out of the queue.
+		When a priority is full, new messages of it are dropped, or with
+		block set, put waits until a message of that priority was taken.
+	"""
+
+	def __init__(self, capacity=MAX_INBOUND_MESSAGES, block=False, priorities=MESSAGE_PRIORITY):
+		self.capacity = capacity
+		self.block = block
+		self.priorities = priorities
+		self.lowest = max(priorities.values())
+
+		## One FIFO per priority
+		self.queues = [deque() for _ in range(self.lowest + 1)]
+		self.lock = threading.Lock()
+		self.not_empty = threading.Condition(self.lock)
+		self.not_full = threading.Condition(self.lock)
+		self.closed = False
+
+		self.received = 0
+		self.max_depth = 0
+
+		## msg_type -> number of messages dropped
+		self.dropped = {}
+
+	def priority(self, msg_type):
+		return self.priorities.get(msg_type, self.lowest)
+
+	def full(self, msg_type):
+		with self.lock:
+			return len(self.queues[self.priority(msg_type)]) >= self.capacity
+
+	def put(self, item, msg_type, block=None):
+		""" Queue a message, returns False if it was dropped """
+		if block is None:
+			block = self.block
+
+		fifo = self.queues[self.priority(msg_type)]
+
+		with self.lock:
+			while block and len(fifo) >= self.capacity and not self.closed:
+				self.not_full.wait()
+
+			if self.closed or len(fifo) >= self.capacity:
+				self.dropped[msg_type] = self.dropped.get(msg_type, 0) + 1
+				return False
+
+			fifo.append(item)
+			self.received += 1
+			self.max_depth = max(self.max_depth, sum(len(q) for q in self.queues))
+			self.not_empty.notify()
+
+		return True
+
+	def get(self, block=True):
+		""" The next message, or None once the queue is closed and empty, or
+			right away if it is empty and block is False
+		"""
+		with self.lock:
+			while True:
+				for fifo in self.queues:
+					if fifo:
+						item = fifo.popleft()
+						## Waiters may be waiting for different priorities
+						self.not_full.notify_all()
+						return item
+
+				if self.closed or not block:
+					return None
+
+				self.not_empty.wait()
+
+	def close(self):
+		""" Wake every waiter, no more messages are accepted """
+		with self.lock:
+			self.closed = True
+			self.not_empty.notify_all()
+			self.not_full.notify_all()
+
+	def __len__(self):
+		with self.lock:
+			return sum(len(q) for q in self.queues)
+
+	def stats(self):
+		""" Depth of each priority, the largest total depth seen, and the number
+			of received and dropped messages
+		"""
+		with self.lock:
+			return {
+				'depth': [len(q) for q in self.queues],
+				'max_depth': self.max_depth,
+				'received': self.received,
+				'dropped': dict(self.dropped),
+			}
+
+class SocketReader:
+	""" Buffered reads from a blocking socket. Data is received with recv_into
+		a reusable buffer, so a line costs one syscall per buffer fill instead
+		of one per byte, and is copied once instead of on every byte.
+		@param s: the connected socket
+		@param size: initial size of the buffer, it grows for longer reads
+	"""
+
+	def __init__(self, s, size=4096):
+		self.s = s
+		self.buf = bytearray(size)
+		self.view = memoryview(self.buf)
+		## Unread data is buf[start:end]
+		self.start = 0
+		self.end = 0
+
+	def fill(self):
+		""" Receive more data behind what is buffered, raises an exception if the
+			socket is closed
+		"""
+		if self.start == self.end:
+			self.start = self.end = 0
+		elif self.end == len(self.buf):
+			pending = self.end - self.start
+
+			if self.start > 0:
+				## Move the unread data to the front
+				self.buf[:pending] = self.buf[self.start:self.end]
+			else:
+				## The buffer is full of unread data, double it
+				self.view.release()
+				self.buf.extend(bytes(len(self.buf)))
+				self.view = memoryview(self.buf)
+
+			self.start = 0
+			self.end = pending
+
+		n = self.s.recv_into(self.view[self.end:])
+
+		if n == 0:
+			raise ConnectionError('Connection closed with %d unread bytes' %(self.end - self.start))
+
+		self.end += n
+
+	def readexactly(self, n):
+		""" Read exactly n bytes, raises an exception if the socket is closed before """
+		if self.end - self.start >= n:
+			data = bytes(self.view[self.start:self.start + n])
+			self.start += n
+			return data
+
+		## Take what is buffered and receive the rest straight into the result
+		data = bytearray(n)
+		got = self.end - self.start
+		data[:got] = self.view[self.start:self.end]
+		self.start = self.end = 0
+		view = memoryview(data)
+
+		while got < n:
+			count = self.s.recv_into(view[got:])
+
+			if count == 0:
+				raise ConnectionError('Connection closed after %d of %d bytes' %(got, n))
+
+			got += count
+
+		return bytes(data)
+
+	def readuntil(self, u, include=False):
+		""" Read until the value specified by 'u' is received
+			include is used to specify if the trailing 'u' data is to be included or excluded
+			from the final returned data
+		"""
+		## Bytes already searched, relative to start
+		searched = 0
+
+		while True:
+			i = self.buf.find(u, self.start + searched, self.end)
+
+			if i >= 0:
+				stop = i + len(u)
+				data = bytes(self.view[self.start:stop if include else i])
+				self.start = stop
+				return data
+
+			## A separator may begin in the last len(u) - 1 bytes
+			searched = max(0, self.end - self.start - len(u) + 1)
+			self.fill()
+
+""" Build a version 2 frame around signed data
+"""
+def pack_frame(data, sig):
+	frame = struct.pack(frame_fmt, FRAME_MAGIC, len(sig), FRAME_VERSION, 0)
+	frame += struct.pack('<Q', len(data))
+	frame += data
+	frame += sig
+
+	return frame
+
+""" Pack several messages into one BATCH message
+"""
+def pack_batch(messages):
+	batch = struct.pack('I', MessageType.BATCH)
+
+	for m in messages:
+		batch += struct.pack(batch_entry_fmt, len(m))
+		batch += m
+
+	return batch
+
+""" Split a BATCH message into its messages. Raises ValueError if an entry
+	runs past the end of the data, the whole batch is malformed then.
+"""
+def unpack_batch(data):
+	messages = []
+	entry_size = struct.calcsize(batch_entry_fmt)
+	pos = struct.calcsize('I')
+
+	while pos < len(data):
+		if pos + entry_size > len(data):
+			raise ValueError('Truncated batch entry at offset %d' %(pos))
+
+		length = struct.unpack_from(batch_entry_fmt, data, pos)[0]
+		pos += entry_size
+
+		if pos + length > len(data):
+			raise ValueError('Batch entry at offset %d runs past the end' %(pos))
+
+		messages.append(data[pos:pos + length])
+		pos += length
+
+	return messages
+
+class Signer:
+	""" Signs data with a private key that is imported only once """
+
+	def __init__(self, key):
+		self.key = key
+		self.signer = PKCS1_v1_5.new(key)
+		self.signatures = 0
+
+	def sig_len(self):
+		return self.key.size_in_bytes()
+
+	def sign(self, data):
+		self.signatures += 1
+		return self.signer.sign(SHA256.new(data))
+
+	def sign_digest(self, digest):
+		self.signatures += 1
+		return self.signer.sign(digest)
+
+class KeyCache:
+	""" Public keys of peers, imported once and kept in memory so that incoming
+		messages can be checked without asking the tracker every time.
+		Entries expire after ttl seconds, the least recently used ones are
+		evicted beyond capacity, and the cache can be saved to a file.
+	"""
+
+	def __init__(self, ttl=KEY_TTL, capacity=KEY_CACHE_SIZE, path=None):
+		self.ttl = ttl
+		self.capacity = capacity
+		self.path = path
+
+		## host -> (RSA key object, PEM bytes, time fetched), least recently used first
+		self.entries = OrderedDict()
+		self.lock = threading.Lock()
+
+		self.hits = 0
+		self.misses = 0
+
+		if self.path is not None:
+			self.load()
+
+	def get(self, host):
+		""" The imported key of a host, or None if it is unknown or expired """
+		with self.lock:
+			entry = self.entries.get(host)
+
+			if entry is None or time.time() - entry[2] > self.ttl:
+				self.entries.pop(host, None)
+				self.misses += 1
+				return None
+
+			self.entries.move_to_end(host)
+			self.hits += 1
+			return entry[0]
+
+	def put(self, host, pem, fetched=None):
+		""" Import and store a key, raises an exception if it is invalid """
+		key = RSA.importKey(pem)
+
+		with self.lock:
+			self.entries[host] = (key, pem, fetched or time.time())
+			self.entries.move_to_end(host)
+
+			while len(self.entries) > self.capacity:
+				self.entries.popitem(last=False)
+
+		return key
+
+	def invalidate(self, host):
+		with self.lock:
+			self.entries.pop(host, None)
+
+	def retain(self, hosts):
+		""" Drop the keys of every host not in hosts, e.g. peers the tracker no longer lists """
+		with self.lock:
+			for host in [ h for h in self.entries if h not in hosts ]:
+				del self.entries[host]
+
+	def load(self):
+		try:
+			with open(self.path, 'r') as f:
+				saved = json.load(f)
+		except (OSError, ValueError):
+			return
+
+		for host, (pem, fetched) in saved.items():
+			if time.time() - fetched > self.ttl:
+				continue
+
+			try:
+				self.put(host.encode('utf-8'), pem.encode('utf-8'), fetched)
+			except:
+				print('[ERROR] Invalid cached public key for %s' %(host))
+
+	def save(self):
+		if self.path is None:
+			return
+
+		with self.lock:
+			saved = { host.decode('utf-8'): (pem.decode('utf-8'), fetched)
+					  for host, (_, pem, fetched) in self.entries.items() }
+
+		tmp = self.path + '.tmp'
+		with open(tmp, 'w') as f:
+			json.dump(saved, f)
+
+		os.replace(tmp, self.path)
+
+class PeerConnection:
+	""" A long-lived connection to one peer. Messages are queued and written by
+		a thread of its own, so a slow or dead peer doesn't hold up the others.
+		When the connection drops it is reopened with exponential backoff.
+	"""
+
+	def __init__(self, host, port):
+		self.host = host
+		self.port = port
+		self.fd = None
+
+		## Entries are (time queued, frame), a Queue of pieces for a stream, or None to stop
+		self.queue = queue.Queue(MAX_QUEUED_MESSAGES)
+
+		## Reconnect backoff
+		self.backoff = MIN_BACKOFF
+		self.retry_at = 0
+
+		## Statistics
+		self.sent = 0
+		self.dropped = 0
+		self.last_latency = 0.0
+		self.avg_latency = 0.0
 
-	while data.endswith(u) == False:
-		data += s.recv(1)
+		self.thread = threading.Thread(target = self.run, args = (), daemon = True)
+		self.thread.start()
 
-	if include == False:
-		data = data.rstrip(u)
+	def send(self, data):
+		""" Queue a complete frame """
+		try:
+			self.queue.put_nowait((time.time(), data))
+		except queue.Full:
+			self.dropped += 1
+			print('[ERROR] Send queue full, dropping a message for %s' %(self.host))
+
+	def open_stream(self):
+		""" Queue a streamed frame. Returns a queue to put its pieces on, ended by None,
+			or None if the send queue is full. The pieces are written back to back.
+		"""
+		pieces = queue.Queue(STREAM_QUEUE_SIZE)
+
+		try:
+			self.queue.put_nowait((time.time(), pieces))
+		except queue.Full:
+			self.dropped += 1
+			print('[ERROR] Send queue full, dropping a stream for %s' %(self.host))
+			return None
+
+		return pieces
+
+	def stats(self):
+		return {
+			'queued': self.queue.qsize(),
+			'sent': self.sent,
+			'dropped': self.dropped,
+			'latency': self.last_latency,
+			'avg_latency': self.avg_latency,
+		}
+
+	def connect(self):
+		## Wait for the backoff after a failed attempt
+		delay = self.retry_at - time.time()
+		if delay > 0:
+			time.sleep(delay)
+
+		fd = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		fd.settimeout(SEND_TIMEOUT)
+
+		try:
+			fd.connect((self.host, self.port))
+		except:
+			print('[ERROR] Failed to connect to %s:%d' %(self.host, self.port))
+			fd.close()
+			self.retry_at = time.time() + self.backoff
+			self.backoff = min(self.backoff * 2, MAX_BACKOFF)
+			return False
+
+		self.fd = fd
+		self.backoff = MIN_BACKOFF
+		return True
+
+	def disconnect(self):
+		if self.fd is not None:
+			self.fd.close()
+			self.fd = None
+
+	def is_closed(self):
+		""" Peers never write on these connections, so a readable socket means it was closed """
+		try:
+			readable, _, _ = select.select([ self.fd ], [], [], 0)
+			return len(readable) > 0 and self.fd.recv(1, socket.MSG_PEEK) == b''
+		except:
+			return True
+
+	def write(self, data):
+		""" Write data, reconnecting if needed """
+		for attempt in range(SEND_ATTEMPTS):
+			if self.fd is not None and self.is_closed():
+				self.disconnect()
+
+			if self.fd is None and not self.connect():
+				continue
+
+			try:
+				self.fd.sendall(data)
+				return True
+			except:
+				self.disconnect()
+
+		return False
+
+	def write_stream(self, pieces):
+		""" Write the pieces of a streamed frame. Only the first piece can be retried
+			on a new connection, after a failure the rest is drained and dropped.
+		"""
+		ok = True
+		first = True
+
+		for piece in iter(pieces.get, None):
+			if not ok:
+				continue
+
+			if first:
+				ok = self.write(piece)
+				first = False
+				continue
+
+			try:
+				self.fd.sendall(piece)
+			except:
+				self.disconnect()
+				ok = False
+
+		return ok
+
+	def run(self):
+		while True:
+			item = self.queue.get()
+
+			if item is None:
+				break
+
+			queued_at, data = item
+
+			if isinstance(data, queue.Queue):
+				ok = self.write_stream(data)
+			else:
+				ok = self.write(data)
+
+			if ok:
+				self.sent += 1
+				self.last_latency = time.time() - queued_at
+				self.avg_latency = 0.8 * self.avg_latency + 0.2 * self.last_latency
+				print("[INFO] Data sent to peer:", self.host)
+			else:
+				self.dropped += 1
+				print('[ERROR] Failed to send to %s:%d, message dropped' %(self.host, self.port))
+
+		self.disconnect()
+
+	def close(self):
+		## Let the queued messages go out first
+		self.queue.put(None)
+		self.thread.join()
+
+class ConnectionPool:
+	""" One PeerConnection per peer host, created on first use """
+
+	def __init__(self, port):
+		self.port = port
+		self.connections = {}
+		self.lock = threading.Lock()
+
+	def get(self, host):
+		## Peers are known by bytes in the peer list, but handlers get the sender as str
+		if isinstance(host, bytes):
+			host = host.decode('utf-8')
+
+		with self.lock:
+			if host not in self.connections:
+				self.connections[host] = PeerConnection(host, self.port)
+
+			return self.connections[host]
+
+	def send(self, hosts, data):
+		for host in hosts:
+			self.get(host).send(data)
+
+	def open_streams(self, hosts):
+		streams = []
+
+		for host in hosts:
+			pieces = self.get(host).open_stream()
+
+			if pieces is not None:
+				streams.append(pieces)
+
+		return streams
+
+	def remove(self, host):
+		if isinstance(host, bytes):
+			host = host.decode('utf-8')
 
-	return data
+		with self.lock:
+			conn = self.connections.pop(host, None)
+
+		if conn is not None:
+			conn.close()
+
+	def stats(self):
+		with self.lock:
+			connections = list(self.connections.items())
+
+		return { host: conn.stats() for host, conn in connections }
+
+	def close(self):
+		with self.lock:
+			connections = list(self.connections.values())
+			self.connections = {}
+
+		for conn in connections:
+			conn.close()
+
+class TrackerClient:
+	""" One persistent connection to the tracker, over which requests are sent
+		and answered one at a time. It is reopened when it fails.
+	"""
+
+	def __init__(self, host, port):
+		self.host = host
+		self.port = port
+		self.fd = None
+		self.reader = None
+		self.request_id = 0
+		self.lock = threading.Lock()
+
+	def request(self, request_type, payload=b''):
+		""" Send a request and wait for its response. Returns (status, payload),
+			raises an exception if the tracker can't be reached
+		"""
+		with self.lock:
+			## Every request can be repeated, so a request that fails on a broken
+			## connection is tried once more on a new one
+			for attempt in range(2):
+				try:
+					if self.fd is None:
+						self.fd = socket.create_connection((self.host, self.port), timeout = SEND_TIMEOUT)
+						self.reader = SocketReader(self.fd)
+
+					self.request_id = (self.request_id + 1) % 2**32
+					self.fd.sendall(struct.pack(tracker_request_fmt, self.request_id, request_type, len(payload)) + payload)
+
+					request_id, status, length = struct.unpack(tracker_response_fmt,
+						self.reader.readexactly(struct.calcsize(tracker_response_fmt)))
+					response = self.reader.readexactly(length)
+
+					if request_id != self.request_id:
+						raise ValueError('Response to request %d, expected %d' %(request_id, self.request_id))
+
+					return status, response
+				except:
+					self.close()
+
+					if attempt == 1:
+						raise
+
+	def close(self):
+		if self.fd is not None:
+			self.fd.close()
+			self.fd = None
+			self.reader = None
 
 class Peer:
 	"""This class is the main tracker class used to manage
 		peers in the blockchain network. It will store public keys too."""
 
-	def __init__(self, tracker, tracker_port=60666, sig_port=60667, list_port=60668,
-					conn_port=60669, pubkey="public.pem", privkey="private.pem" ):
+	def __init__(self, tracker, tracker_port=60666, conn_port=60669, pubkey="public.pem", privkey="private.pem", key_cache=None,
+					handler_workers=1, queue_size=MAX_INBOUND_MESSAGES, queue_block=False ):
 		""" Connect to the tracker an announce as a new peer. Send the public key that
 			will be used for signing.
 
@@ -37,18 +721,9 @@ class Peer:
 			
 			tracker is the hostname or ip of the tracker server
 
-			tracker_port is the port on which to connect and announce as a peer.
-
-			sig_port is used for peers to connect and send a request for
-				the public key of a specific peer. If the tracker has one
-				then it will respond in kind otherwise it will responde with
-				the string 'Unknown'. Signatures will be stored based upon the
-				hostname of the peer.
-
-			list_port is used for peers to connect and request the list of
-				peers in the network. If the requesting peer is not in the
-				registered list then Rejected will be returned otherwise,
-				the list of known nodes will be returned.
+			tracker_port is the port of the tracker. One connection to it is kept
+				open for every request: announcing as a peer, getting the peer
+				list, and the public keys of other peers.
 
 			conn_port is used by the peer to allow the tracker and other peers to connect to it.
 
@@ -56,18 +731,32 @@ class Peer:
 				this to validate signatures on data
 
 			privkey will not be sent anywhere but is used to sign data sent to peers
+
+			key_cache is an optional file in which the public keys of peers are saved,
+				so that they don't all have to be fetched from the tracker again after a restart
+
+			handler_workers is the number of threads that check and handle received
+				messages, off the event loop that reads them. With one thread, the
+				handlers run one at a time. With none, received messages are left in
+				the queue for get_new_message.
+
+			queue_size is the number of received messages of each priority that
+				can wait for a handler thread. Beyond it new messages are dropped,
+				or with queue_block set, the connection they came from is not read
+				until there is room again.
 		"""
 
 		## Save all of the values for later
 		self.stop_peering = False
 		self.tracker = tracker
 		self.tracker_port = tracker_port
-		self.sig_port = sig_port
-		self.list_port = list_port
 		self.conn_port = conn_port
 
-		## Queue used to store validated messages from other peers
-		self.message_queue = []
+		## Requests to the tracker go over this connection
+		self.tracker_conn = TrackerClient(tracker, tracker_port)
+
+		## Received messages waiting for a handler thread, highest priority first
+		self.message_queue = MessageQueue(queue_size, queue_block)
 
 		## While this is 1 the ping thread will continue
 		self.peer_loop = 1
@@ -75,15 +764,40 @@ class Peer:
 		## Stores the time of the last peer update
 		self.last_peer_check = 0
 
+		## Stores the time of the last heartbeat sent to the tracker
+		self.last_heartbeat = 0
+
+		## Heartbeats are sent as datagrams to the tracker_port
+		self.heartbeatfd = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
 		## Stores the known peers and their associated keys if available
 		self.peers = {}
 
+		## Version of the tracker's peer list that self.peers matches, a
+		## session of 0 gets the full list
+		self.list_session = 0
+		self.list_epoch = 0
+
 		## get the current node's host_name so to ignore self in peer list
 		self.host_name = socket.gethostbyname(socket.gethostname()).encode("ascii")
 
 		## Store registered handlers for handling different types of msgs
 		self.msg_handlers = {}
 
+		## Threads that check and handle received messages
+		self.handlers = []
+
+		for i in range(handler_workers):
+			handler = threading.Thread(target = self.handle_messages, daemon = True)
+			handler.start()
+			self.handlers.append(handler)
+
+		## Long-lived outgoing connections to the other peers
+		self.connections = ConnectionPool(conn_port)
+
+		## Public keys of the other peers
+		self.keys = KeyCache(path=key_cache)
+
 		## Open and read the public and private keys
 		try:
 			f = open(pubkey, 'rb')
@@ -116,52 +830,34 @@ class Peer:
 			print('[ERROR] Invalid private key')
 			exit(1)
 
-		## Connect to the tracker and announce with the public key
-		fd = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		## Signs everything sent, with the key imported above
+		self.signer = Signer(self.rsa_privkey)
 
+		## Small messages waiting to be signed and sent together, by target
+		self.batches = {}
+		self.batch_lock = threading.Lock()
+		self.batch_timer = None
+
+		## Announce with the public key, and get the peer list and the keys of
+		## all peers in the same round-trip
 		try:
-			fd.connect((self.tracker, self.tracker_port))
+			status, response = self.tracker_conn.request(TrackerRequest.BOOTSTRAP, self.pubkey)
 		except:
 			print('[ERROR] Failed to connect to %s: %d' %(self.tracker, self.tracker_port))
 			exit(1)
 
-		fd.send(self.pubkey)
-
-		response = fd.recv(1024)
-
-		fd.close()
-
-		if response != b'Accepted':
-			print('[ERROR] Tracker did not accept the public key: %s' %response)
+		if status != TrackerStatus.OK:
+			print('[ERROR] Tracker did not accept the public key: %d' %status)
 			exit(1)
 
 		print('[INFO] Tracker accepted the public key')
 
-		## Connect and git a list of peers
-		fd = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-
 		try:
-			fd.connect((self.tracker, self.list_port))
+			self.bootstrap(response)
 		except:
-			print('[ERROR] Failed to connect to %s: %d' %(self.tracker, self.tracker_port))
+			print('[ERROR] Invalid bootstrap response from the tracker')
 			exit(1)
 
-		entry_count = readuntil(fd, b'\n')
-
-		for e in range(int(entry_count)):
-			peer = readuntil(fd, b'\n')
-
-			## make sure the peer isn't me
-			if peer == self.host_name:
-				continue
-
-			## This will hold the signatures too
-			self.peers[peer] = {'sig': None}
-
-			print('[INFO] Added peer: %s' %(peer))
-
-		fd.close()
-
 		## Set the initial peer check
 		self.last_peer_check = time.time()
 
@@ -178,7 +874,7 @@ class Peer:
 		## Start the listener
 		self.peerfd.listen(10)
 
-		print('[INFO] Peer listening on port: %d' %(list_port))
+		print('[INFO] Peer listening on port: %d' %(conn_port))
 
 		## Create a thread to periodically do a peer list update
 		self.peer_update = threading.Thread(target = self.update_peer_list, args = ())
@@ -195,44 +891,38 @@ class Peer:
 		return signer.verify(digest, signature)
 
 	def get_peer_signature(self, peer):
-		""" Connects to the tracker and requests the signature of
-			the specified peer
+		""" Returns the public key of the specified peer from the key cache,
+			or connects to the tracker and requests it when it isn't cached
 		"""
 		## If we don't know this peer then we don't need to request it
 		if peer not in self.peers:
-			return 1
+			return None
 
-		fd = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		key = self.keys.get(peer)
+		if key is not None:
+			return key
 
 		try:
-			fd.connect((self.tracker, self.sig_port))
+			status, signature = self.tracker_conn.request(TrackerRequest.GET_KEY, peer)
 		except:
-			print('[ERROR] Failed to connect to tracker signature port: %s:%d' %(self.tracker, self.sig_port))
-			return 1
-
-		fd.send(peer)
-
-		## get the signature length
-		siglen = struct.unpack('I', fd.recv(4))[0]
-
-		signature = fd.recv(siglen)
-
-		fd.close()
+			print('[ERROR] Failed to receive the public key of %s' %(peer))
+			return None
 
 		## Check for the failure case
-		if siglen == 'Unknown':
-			return 1
+		if status != TrackerStatus.OK:
+			return None
 
 		## Import the key to ensure that it is valid
 		try:
-			rsa_pubkey = RSA.importKey(signature)
+			key = self.keys.put(peer, signature)
 		except:
 			print('[ERROR] Invalid public key')
-			return 1
+			return None
 
 		self.peers[peer]['sig'] = signature
+		self.keys.save()
 
-		return 0
+		return key
 
 	def handle_new_block(self, fd):
 		"""
@@ -255,113 +945,291 @@ class Peer:
 		sig = fd.recv(sig_len)
 
 		## Do I have the signature for this peer?
-		if self.get_peer_signature(client[0].encode('utf-8')):
+		if self.get_peer_signature(client[0].encode('utf-8')) is None:
 			print('[ERROR] Failed to get a signature for the peer: %s' %client)
 			return
 
 		return
 
-	def send_signed_data(self, data, target=None):
-		""" This sends data to every peer in the list """
+	def send_targets(self, target=None):
+		if target is None:
+			return list(self.peers)
+
+		return [ target ]
+
+	def send_signed_data(self, data, target=None, batch=False):
+		""" This sends data to every peer in the list
+
+			With batch set, the data waits up to BATCH_DELAY seconds for other
+			small messages to the same target, and they are signed and sent
+			together as one BATCH message.
+		"""
+		if batch:
+			self.add_to_batch(data, target)
+
+			return
 
-		### Use my private key to sign the data
-		key = RSA.importKey(self.privkey)
+		## The data is signed once, whatever the number of peers
+		block = pack_frame(data, self.signer.sign(data))
+
+		## Every peer connection writes in parallel on its own thread
+		self.connections.send(self.send_targets(target), block)
+
+		return
+
+	def add_to_batch(self, data, target):
+		with self.batch_lock:
+			messages = self.batches.setdefault(target, [])
+			messages.append(data)
+			full = len(messages) >= MAX_BATCH
+
+			if not full and self.batch_timer is None:
+				self.batch_timer = threading.Timer(BATCH_DELAY, self.flush_batches)
+				self.batch_timer.daemon = True
+				self.batch_timer.start()
+
+		if full:
+			self.flush_batches()
+
+	def flush_batches(self):
+		""" Sign and send every waiting batch """
+		with self.batch_lock:
+			batches = self.batches
+			self.batches = {}
+
+			if self.batch_timer is not None:
+				self.batch_timer.cancel()
+				self.batch_timer = None
+
+		for target, messages in batches.items():
+			if len(messages) == 1:
+				self.send_signed_data(messages[0], target)
+			else:
+				self.send_signed_data(pack_batch(messages), target)
+
+	def send_signed_stream(self, chunks, target=None):
+		""" Like send_signed_data, but the data is given as an iterable of byte strings
+			and sent chunk by chunk as it is produced, so it never has to be
+			held in memory at once. The signature is computed along the way
+			and sent last.
+		"""
+		streams = self.connections.open_streams(self.send_targets(target))
+
+		sig_len = self.signer.sig_len()
+		header = struct.pack(frame_fmt, FRAME_MAGIC, sig_len, FRAME_VERSION, FLAG_CHUNKED)
+
+		for pieces in streams:
+			pieces.put(header)
 
 		digest = SHA256.new()
-		digest.update(data)
+		pending = bytearray()
 
-		sig = PKCS1_v1_5.new(key).sign(digest)
+		for chunk in chunks:
+			pending += chunk
 
-		block = struct.pack('H', len(data))
-		block += struct.pack('H', len(sig))
-		block += data
-		block += sig
+			if len(pending) >= STREAM_CHUNK_SIZE:
+				digest.update(pending)
+				piece = struct.pack('<I', len(pending)) + pending
 
-		if target is None:
-			targets = self.peers
-		else:
-			targets = [ target ]
-		
-		target_copy = targets.copy()
-		for p in target_copy:
-			fd = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+				for pieces in streams:
+					pieces.put(piece)
 
-			try:
-				fd.connect((p, self.conn_port))
-			except:
-				print('[ERROR] Failed to connect to %s:%d' %(p, self.conn_port))
-				continue
+				pending = bytearray()
 
-			print("[INFO] Data sent to peer:", p)
-			fd.sendall(block)
+		if len(pending) > 0:
+			digest.update(pending)
+			piece = struct.pack('<I', len(pending)) + pending
 
-			fd.close()
+			for pieces in streams:
+				pieces.put(piece)
+
+		## A zero length chunk ends the data, then comes the signature
+		sig = self.signer.sign_digest(digest)
+
+		for pieces in streams:
+			pieces.put(struct.pack('<I', 0) + sig)
+			pieces.put(None)
 
 		return
 
+	def connection_stats(self):
+		""" Queue depth, message counts and send latency (seconds) of each peer connection """
+		return self.connections.stats()
+
+	def message_stats(self):
+		""" Depth and counters of the queue of received messages """
+		return self.message_queue.stats()
+
 	def get_new_message(self):
-		if len(self.message_queue) == 0:
-			return None
+		""" The next validated (data, sig) that no handler thread took, or None.
+			Queued messages whose signature doesn't verify are dropped.
+		"""
+		while True:
+			item = self.message_queue.get(block = False)
 
-		return self.message_queue.pop(0)
+			if item is None:
+				return None
 
-	def handle_client(self, fd):
-		## If the size fields are 0 then this is a ping
+			data, sig, src = item
+
+			if self.verify_message(data, sig, src):
+				return data, sig
+
+	async def read_message(self, reader, writer):
+		""" Read one message from a connection. Returns (data, sig), or None
+			for a ping or when the other side closed the connection.
+		"""
 		## read a 2-byte size field for the data length and 2-byte size field for signature length
 		try:
-			data_len = struct.unpack('H', fd.recv(2))[0]
-			sig_len = struct.unpack('H', fd.recv(2))[0]
-		except:
-			print('[ERROR] Failed to receive data')
-			fd.close()
+			header = await reader.readexactly(struct.calcsize(legacy_frame_fmt))
+		except asyncio.IncompleteReadError as e:
+			## Without any bytes the other side just closed the connection between messages
+			if e.partial:
+				print('[ERROR] Failed to receive data')
 
-			return
+			return None
 
-		if data_len == 0:
+		data_len, sig_len = struct.unpack(legacy_frame_fmt, header)
+
+		## If the size fields are 0 then this is a ping
+		if data_len == 0 and sig_len == 0:
 			print('[INFO] Received a ping.')
-			fd.send(struct.pack('I', 0x41414141))
-			fd.close()
+			writer.write(struct.pack('I', 0x41414141))
+			await writer.drain()
 
-			return
+			return None
 
-		## Read the data and signature
-		try:
-			data = fd.recv(data_len)
-			while len(data) < data_len:
-				print("[EXCEPTION] Data recv is not complete, now try to recv more.")
-				data += fd.recv(data_len - len(data))
-
-			sig = fd.recv(sig_len)
-			while len(sig) < sig_len:
-				print("[EXCEPTION] Sig recv is not complete, now try to recv more.")
-				sig += fd.recv(sig_len - len(sig))
-		except:
-			print('[ERROR] Failed to receive client data')
-			fd.close()
+		if data_len == FRAME_MAGIC:
+			## A versioned frame, with a 64-bit length or a chunked body
+			version, flags = struct.unpack('<BB', await reader.readexactly(2))
 
-			return
+			if version != FRAME_VERSION:
+				raise ValueError('Unsupported frame version %d' %(version))
 
-		client = fd.getpeername()
+			if flags & FLAG_CHUNKED:
+				data = bytearray()
+
+				while True:
+					chunk_len = struct.unpack('<I', await reader.readexactly(4))[0]
+
+					if chunk_len == 0:
+						break
 
-		fd.close()
+					if len(data) + chunk_len > MAX_MESSAGE_SIZE:
+						raise ValueError('Message larger than %d bytes' %(MAX_MESSAGE_SIZE))
+
+					data += await reader.readexactly(chunk_len)
+
+				data = bytes(data)
+			else:
+				data_len = struct.unpack('<Q', await reader.readexactly(8))[0]
+
+				if data_len > MAX_MESSAGE_SIZE:
+					raise ValueError('Message larger than %d bytes' %(MAX_MESSAGE_SIZE))
+
+				data = await reader.readexactly(data_len)
+		else:
+			data = await reader.readexactly(data_len)
+
+		sig = await reader.readexactly(sig_len)
+
+		return data, sig
+
+	async def handle_connection(self, reader, writer):
+		""" Read messages from a connection until it is closed. Peers keep their
+			connection open for more messages. Reading never waits for the
+			handlers: the messages are queued, then checked and handled by the
+			handler threads.
+		"""
+		client = writer.get_extra_info('peername')
+		print('[INFO] Connection from Tracker / a new peer: ', client)
 
-		print('[INFO] Received a new message from: ', client)
+		loop = asyncio.get_running_loop()
 
+		try:
+			while True:
+				try:
+					message = await self.read_message(reader, writer)
+				except Exception as e:
+					print('[ERROR] Failed to receive client data:', e)
+					break
+
+				if message is None:
+					break
+
+				print('[INFO] Received a new message from: ', client)
+
+				data, sig = message
+				msg_type = message_type(data)
+				item = (data, sig, client[0])
+
+				## Only this loop adds messages, so the queue can't fill up between
+				## the two calls and put only waits in the executor
+				if self.message_queue.block and self.message_queue.full(msg_type):
+					await loop.run_in_executor(None, self.message_queue.put, item, msg_type)
+				elif not self.message_queue.put(item, msg_type):
+					print('[ERROR] Message queue full, dropped a message from: ', client)
+		finally:
+			writer.close()
+
+	def handle_messages(self):
+		""" Body of a handler thread, runs until the message queue is closed """
+		while True:
+			item = self.message_queue.get()
+
+			if item is None:
+				return
+
+			self.handle_message(*item)
+
+	def handle_message(self, data, sig, src):
+		""" Check the signature of a message and hand it to its handler.
+			Runs on a handler thread.
+		"""
+		try:
+			if self.verify_message(data, sig, src):
+				self.dispatch(data, src)
+		except:
+			print('[ERROR] Failed to handle a message from: ', src)
+			traceback.print_exc()
+
+	def verify_message(self, data, sig, src):
+		""" Check the signature of a received message with the key of the peer it came from """
 		## Do I have the signature for this peer?
-		if self.get_peer_signature(client[0].encode('utf-8')):
-			print('[ERROR] Failed to get a signature for the peer: ', client)
-			return
+		key = self.get_peer_signature(src.encode('utf-8'))
+		if key is None:
+			print('[ERROR] Failed to get a signature for the peer: ', src)
+			return False
+
+		if not self.verify_signature(data, sig, key):
+			print('[ERROR] Invalid signature on message from: ', src)
+			return False
 
 		print('[INFO] Signature verified on new message')
 
-		self.message_queue.append( (data, sig) )
+		return True
 
+	def dispatch(self, data, src):
+		""" Hand a verified message to the handler registered for its type """
 		msg_type, = struct.unpack_from("I", data)
 		print("[INFO] Received new Message of type:", msg_type)
-		if msg_type in self.msg_handlers:
-			self.msg_handlers[msg_type](data, client[0])
 
-		return;
+		if msg_type == MessageType.BATCH:
+			try:
+				messages = unpack_batch(data)
+			except ValueError as e:
+				print('[ERROR] Malformed batch from: ', src, e)
+				return
+
+			for message in messages:
+				## Batches are never nested, a nested one is dropped rather than recursed into
+				if len(message) >= struct.calcsize("I") and struct.unpack_from("I", message)[0] == MessageType.BATCH:
+					print('[ERROR] Nested batch from: ', src)
+					continue
+
+				self.dispatch(message, src)
+		elif msg_type in self.msg_handlers:
+			self.msg_handlers[msg_type](data, src)
 
 	def register_msg_handler(self, msg_type, handler):
 		self.msg_handlers[msg_type] = handler
@@ -371,67 +1239,146 @@ class Peer:
 		self.peer_loop = 0
 		self.stop_peering = True
 		self.peer_update.join()
+		self.flush_batches()
+		self.connections.close()
+		self.message_queue.close()
+		self.heartbeatfd.close()
+		self.tracker_conn.close()
+
+	def bootstrap(self, response):
+		""" Take the peer list and keys of a BOOTSTRAP response """
+		count_size = struct.calcsize(tracker_count_fmt)
+		key_size = struct.calcsize(tracker_key_fmt)
+
+		list_len = struct.unpack_from(tracker_count_fmt, response)[0]
+		pos = count_size + list_len
+		self.apply_peer_list(response[count_size:pos])
+
+		key_count = struct.unpack_from(tracker_count_fmt, response, pos)[0]
+		pos += count_size
+
+		for k in range(key_count):
+			host_len, key_len = struct.unpack_from(tracker_key_fmt, response, pos)
+			pos += key_size
+			host = response[pos:pos + host_len]
+			pem = response[pos + host_len:pos + host_len + key_len]
+			pos += host_len + key_len
+
+			if host not in self.peers:
+				continue
 
-	def update_peer_list(self):
+			try:
+				self.keys.put(host, pem)
+			except:
+				print('[ERROR] Invalid public key for %s' %(host))
+				continue
 
-		while(self.peer_loop):
-			time.sleep(5)
+			self.peers[host]['sig'] = pem
 
-			if time.time() - self.last_peer_check > 10:
-				print('[INFO] Updating the peer list')
-				## Connect and git a list of peers
-				fd = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	def fetch_peer_list(self):
+		""" Get the changes to the tracker's peer list since the last fetch and
+			apply them. The first fetch, and one after the tracker restarted or
+			lost track of our epoch, gets the full list instead.
+			Returns False if the list could not be fetched.
+		"""
+		try:
+			status, response = self.tracker_conn.request(TrackerRequest.GET_PEERS,
+				struct.pack(peer_list_request_fmt, self.list_session, self.list_epoch))
 
-				try:
-					fd.connect((self.tracker, self.list_port))
-				except:
-					print('[ERROR] Failed to connect to %s: %d' %(self.tracker, self.tracker_port))
-					return
+			if status != TrackerStatus.OK:
+				raise ValueError('Status %d' %status)
+
+			self.apply_peer_list(response)
+		except:
+			print('[ERROR] Failed to get the peer list from %s: %d' %(self.tracker, self.tracker_port))
+			return False
+
+		return True
+
+	def apply_peer_list(self, response):
+		""" Apply a peer list, see peer_list_request_fmt for its format """
+		lines = response.split(b'\n')
+		session, epoch, kind = lines[0].split()
+		entries = lines[2:2 + int(lines[1])]
+
+		if kind == b'F':
+			listed = set( e[1:] for e in entries )
+
+			for peer in [ p for p in self.peers if p not in listed ]:
+				self.remove_peer(peer)
+
+			## Keys of peers that left the network are no longer needed
+			self.keys.retain(listed)
+
+		for entry in entries:
+			change, peer = entry[:1], entry[1:]
+
+			## make sure the peer isn't me
+			if peer == self.host_name:
+				continue
 
-				entry_count = readuntil(fd, b'\n')
+			if change == b'+' and peer not in self.peers:
+				## This will hold the signatures too
+				self.peers[peer] = {'sig': None}
 
-				for e in range(int(entry_count)):
-					peer = readuntil(fd, b'\n')
+				print('[INFO] Added peer: %s' %(peer))
+			elif change == b'-':
+				self.remove_peer(peer)
 
-					## Todo: Make sure to remove a disconnected peer
+		self.list_session = int(session)
+		self.list_epoch = int(epoch)
 
-					## This will hold the signatures too
-					if peer not in self.peers and peer != self.host_name:
-						self.peers[peer] = {'sig': None}
+	def remove_peer(self, peer):
+		""" Forget a peer that left the network, with its connection and key """
+		if self.peers.pop(peer, None) is None:
+			return
+
+		self.connections.remove(peer)
+		self.keys.invalidate(peer)
+
+		print('[INFO] Removed peer: %s' %(peer))
+
+	def send_heartbeat(self):
+		""" Renew this peer's lease at the tracker with a signed heartbeat """
+		data = struct.pack(heartbeat_fmt, time.time())
+
+		try:
+			self.heartbeatfd.sendto(data + self.signer.sign(data), (self.tracker, self.tracker_port))
+		except:
+			print('[ERROR] Failed to send a heartbeat to %s: %d' %(self.tracker, self.tracker_port))
+
+		self.last_heartbeat = time.time()
+
+	def update_peer_list(self):
 
-						print('[INFO] Added peer: %s' %(peer))
+		while(self.peer_loop):
+			time.sleep(5)
 
-				fd.close()
+			if time.time() - self.last_heartbeat > HEARTBEAT_INTERVAL:
+				self.send_heartbeat()
+
+			if time.time() - self.last_peer_check > 10:
+				print('[INFO] Updating the peer list')
+				self.fetch_peer_list()
 
 				self.last_peer_check = time.time()
 
 		return
 
 	def run(self):
-		inputs = [ self.peerfd ]
-
-		while inputs:
-			if self.stop_peering:
-				break
-			readable, writable, exceptional = select.select(inputs, [], inputs, 5)
-
-			for r in readable:
-				if r is self.peerfd:
-					clientfd, client_address = self.peerfd.accept()
+		""" Serve peer connections on an asyncio event loop until interrupt_handler is called """
+		asyncio.run(self.serve())
 
-					## The server has a new connection waiting
-					print('[INFO] Connection from Tracker / a new peer: ', client_address )
-					inputs.append(clientfd)
-				else:
-					self.handle_client(r)
+	async def serve(self):
+		server = await asyncio.start_server(self.handle_connection, sock=self.peerfd)
 
-					## Connections do not remain open so this is no longer needed
-					## It is assumed that handle_client will close the socket
-					inputs.remove(r)
+		async with server:
+			while not self.stop_peering:
+				await asyncio.sleep(1)
 
 
 if __name__ == "__main__":
-	p = Peer(sys.argv[1])
+	p = Peer(sys.argv[1], handler_workers = 0)
 
 	print("THreading...")
 	pa = threading.Thread(target = p.run, args = ())
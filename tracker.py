@@ -4,35 +4,83 @@ import sys
 import select
 import struct
 import time
+import random
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from signal import signal, SIGINT
 from Crypto.PublicKey import RSA
+from Crypto.Signature import PKCS1_v1_5
+from Crypto.Hash import SHA256
+from message import heartbeat_fmt, peer_list_request_fmt, tracker_request_fmt, tracker_response_fmt, \
+	tracker_count_fmt, tracker_key_fmt, TrackerRequest, TrackerStatus
+
+## Seconds between two liveness checks of a peer
+PING_INTERVAL = 20
+
+## Each check is scheduled up to this fraction of PING_INTERVAL earlier or later,
+## so the checks of peers that registered together are spread out
+PING_JITTER = 0.2
+
+## Seconds a peer has to accept a ping connection and to answer it
+PING_TIMEOUT = 5
+
+## Most pings in flight at once
+PING_WORKERS = 32
+
+## A heartbeat keeps a peer registered without pings for this many seconds
+LEASE_TIME = 60
+
+## Peer list changes kept for delta updates, peers further behind get the full list
+MAX_CHANGES = 1024
+
+## Requests with a larger payload are refused and their connection is closed
+MAX_REQUEST_SIZE = 64 * 1024
+
+## Seconds a client has to take a response before its connection is closed
+CLIENT_TIMEOUT = 10
 
 class Tracker:
 	"""This class is the main tracker class used to manage
 		peers in the blockchain network. It will store public keys too."""
 
-	def __init__(self, peer_port=60666, sig_port=60667, list_port=60668, conn_port=60669):
+	def __init__(self, port=60666, conn_port=60669):
 		""" Set up the listening port and initialize the peer variable.
-			peer_port is used for new peers to connect to the network and
-				provide their signature.
-			sig_port is used for peers to connect and send a request for
-				the public key of a specific peer. If the tracker has one
-				then it will respond in kind otherwise it will responde with
-				the string 'Unknown'. Signatures will be stored based upon the
-				hostname of the peer.
-			list_port is used for peers to connect and request the list of
-				peers in the network. If the requesting peer is not in the
-				registered list then Rejected will be returned otherwise,
-				the list of known nodes will be returned.
+			port is the one port peers connect to. Over a connection a peer can
+				send any number of requests, each answered by a response with
+				the same request id:
+				REGISTER provides the peer's public key to join the network.
+				GET_KEY asks for the public key of a specific peer. Keys are
+					stored based upon the hostname of the peer, UNKNOWN is
+					returned if there is none.
+				GET_PEERS asks for the peers added and removed since the epoch
+					the peer asks for, or the full list if it is too far behind.
+				BOOTSTRAP registers and returns the full peer list and the keys
+					of all peers, so that a peer joins with one round-trip.
+				Requests other than REGISTER and BOOTSTRAP are DENIED to hosts
+				that are not registered.
 
 			conn_port is used by the peer to allow the tracker and other peers to connect to it.
-		"""
 
-		## Periodically to a check to make sure that the peers are still live
-		self.last_ping_request = time.time()
+			Peers can also send signed heartbeats as UDP datagrams to the same port. A
+				valid heartbeat renews the peer's lease, and peers with a lease are
+				not pinged.
+		"""
 
 		self.conn_port = conn_port
 
+		## Guards registered, which the ping thread changes too
+		self.lock = threading.Lock()
+
+		## Every peer added or removed bumps the epoch and is recorded as b'+host'
+		## or b'-host', so peers can fetch only the changes since their epoch.
+		## The session tells peers that the epochs started over after a restart.
+		self.session = random.randint(1, 2**63 - 1)
+		self.epoch = 0
+		self.changes = deque(maxlen = MAX_CHANGES)
+
+		## (epoch, encoded entries) of the last full list sent
+		self.full_list = (-1, b'')
+
 		## This is used to indicate that the ping thread should continue
 		## If a user enters CTRL+C then this will be set to 0
 		self.ping_loop = 1
@@ -41,7 +89,7 @@ class Tracker:
 		self.peerfd.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
 		try:
-			self.peerfd.bind(('', peer_port))
+			self.peerfd.bind(('', port))
 		except socket.error as m:
 			print('Bind failed. ', m)
 			sys.exit()
@@ -49,111 +97,323 @@ class Tracker:
 		## Start the listener
 		self.peerfd.listen(10)
 
-		print('[INFO] Tracker listening on port: %d' %(peer_port))
+		print('[INFO] Tracker listening on port: %d' %(port))
 
-		self.sigfd = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-		self.sigfd.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		## Heartbeats from peers arrive on the same port number, over UDP
+		self.heartbeatfd = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 
 		try:
-			self.sigfd.bind(('', sig_port))
+			self.heartbeatfd.bind(('', port))
 		except socket.error as m:
 			print('Bind failed. ', m)
 			sys.exit()
 
-		## Start the listener
-		self.sigfd.listen(10)
+		self.registered = {}
 
-		print('[INFO] Tracker listening on port: %d' %(sig_port))
+		## Connected clients, socket -> {'host': address, 'buffer': unparsed data}
+		self.clients = {}
 
-		self.listfd = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-		self.listfd.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+	def handler(self, s, f):
+		print('[INFO] Shutting down')
+		self.ping_loop = 0
 
-		try:
-			self.listfd.bind(('', list_port))
-		except socket.error as m:
-			print('Bind failed. ', m)
-			sys.exit()
+		self.peer_ping.join()
 
-		## Start the listener
-		self.listfd.listen(10)
+		for clientfd in self.clients:
+			clientfd.close()
 
-		print('[INFO] Tracker listening on port: %d' %(list_port))
+		self.peerfd.close()
+		self.heartbeatfd.close()
 
-		self.registered = {}
+		exit(0)
 
-		## Dict for clients registering as peers
-		self.peers = []
+	def next_check(self):
+		""" Time of the next liveness check of a peer, with jitter """
+		return time.time() + PING_INTERVAL * random.uniform(1 - PING_JITTER, 1 + PING_JITTER)
 
-		## Dict for clients requesting a signature
-		self.sigs = []
+	def ping(self, peer):
+		""" Ping a peer, returns True if it answered within PING_TIMEOUT """
+		try:
+			fd = socket.create_connection((peer, self.conn_port), timeout = PING_TIMEOUT)
+		except:
+			## If this is hit then the peer is dead
+			return False
 
-		## Dict for clients requesting a peer list
-		self.lists = []
+		try:
+			fd.sendall(struct.pack('I', 0x00))
 
-	def handler(self, s, f):
-		print('[INFO] Shutting down')
-		self.ping_loop = 0
+			d = b''
+			while len(d) < 4:
+				chunk = fd.recv(4 - len(d))
 
-		self.peer_ping.join()
+				if not chunk:
+					break
 
-		self.peerfd.close()
-		self.sigfd.close()
-		self.listfd.close()
+				d += chunk
+		except:
+			return False
+		finally:
+			fd.close()
 
-		exit(0)
+		try:
+			value = struct.unpack('I', d)[0]
+		except:
+			print('[ERROR] Invalid number of bytes received')
+			return False
 
-	def perform_ping_check(self):
-		while self.ping_loop:
-			time.sleep(1)
+		if value != 0x41414141:
+			print('[ERROR] Invalid PING response from: %s' %peer)
+			return False
 
-			## Keep a list of the dead and remove them after the checks
-			if time.time() - self.last_ping_request > 20:
-				dead = []
+		return True
 
-				self.last_ping_request = time.time()
+	def perform_ping_check(self):
+		""" Check the liveness of the registered peers until shutdown. Each peer is
+			checked on its own schedule, the pings run in parallel on a thread pool
+			so a hung peer only holds up its own check, and peers holding a
+			heartbeat lease are not pinged at all.
+		"""
+		pool = ThreadPoolExecutor(max_workers = PING_WORKERS)
 
-				## Loops through each known peer and attempts to confirm its liveness
-				for peer in self.registered:
-					fd = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		## Pings in flight, future -> peer
+		checks = {}
 
-					try:
-						fd.connect((peer, self.conn_port))
-					except:
-						## If this is hit then the peer is dead
-						dead.append(peer)
-						fd.close()
-						continue
+		while self.ping_loop:
+			now = time.time()
 
-					fd.send(struct.pack('I', 0x00))
+			with self.lock:
+				checking = set(checks.values())
 
-					try:
-						d = fd.recv(4)
-					except:
-						dead.append(peer)
-						fd.close()
+				for peer, info in self.registered.items():
+					if peer in checking or info['next_check'] > now:
 						continue
 
-					try:
-						value = struct.unpack('I', d)[0]
-					except:
-						print('[ERROR] Invalid number of bytes received')
-						dead.append(peer)
-						fd.close()
+					if info['lease'] > now:
+						## The peer renewed its lease, check again once it runs out
+						info['next_check'] = info['lease']
 						continue
 
-					if value != 0x41414141:
-						print('[ERROR] Invalid PING response from: %s' %peer)
-						dead.append(peer)
+					checks[pool.submit(self.ping, peer)] = peer
+
+			if not checks:
+				time.sleep(1)
+				continue
+
+			done, pending = wait(checks, timeout = 1, return_when = FIRST_COMPLETED)
+
+			for future in done:
+				peer = checks.pop(future)
+				alive = future.result()
 
-					fd.close()
+				with self.lock:
+					info = self.registered.get(peer)
 
+					if info is None:
+						continue
+
+					## A heartbeat that arrived during the ping counts as well
+					if alive or info['lease'] > time.time():
+						info['next_check'] = self.next_check()
+						continue
 
-				for peer in dead:
 					print('[INFO] Removing %s as peer' %(peer))
 					self.registered.pop(peer)
+					self.record_change(b'-', peer)
+
+		pool.shutdown(wait = False)
 
 		return
 
+	def record_change(self, change, host):
+		""" Bump the epoch for an added (b'+') or removed (b'-') peer.
+			Must be called with the lock held.
+		"""
+		self.epoch += 1
+		self.changes.append( (self.epoch, change + host.encode('utf-8') + b'\n') )
+
+	def peer_list(self, session, since):
+		""" The encoded reply to a peer list request. Only the changes after epoch
+			since are sent if all of them are still recorded, otherwise the full list.
+		"""
+		with self.lock:
+			oldest = self.changes[0][0] if self.changes else self.epoch + 1
+
+			if session == self.session and oldest - 1 <= since <= self.epoch:
+				kind = b'D'
+				entries = []
+
+				for epoch, entry in reversed(self.changes):
+					if epoch <= since:
+						break
+
+					entries.append(entry)
+
+				entries.reverse()
+				count = len(entries)
+				entries = b''.join(entries)
+			else:
+				kind = b'F'
+
+				## The full list only changes with the epoch
+				if self.full_list[0] != self.epoch:
+					self.full_list = (self.epoch, b''.join( b'+' + p.encode('utf-8') + b'\n' for p in self.registered ))
+
+				count = len(self.registered)
+				entries = self.full_list[1]
+
+			header = b'%d %d %s\n%d\n' %(self.session, self.epoch, kind, count)
+
+		return header + entries
+
+	def register(self, host, pem):
+		""" Register a host with its PEM public key """
+		try:
+			rsakey = RSA.importKey(pem)
+		except:
+			## If it fails then the key is invalid
+			return TrackerStatus.REJECTED
+
+		with self.lock:
+			if host not in self.registered:
+				self.record_change(b'+', host)
+
+			self.registered[host] = {'signature': pem, 'key': rsakey,
+				'next_check': self.next_check(), 'lease': 0, 'heartbeat': 0}
+
+		print('[INFO] Registered peer: %s' %(host))
+
+		return TrackerStatus.OK
+
+	def all_keys(self):
+		""" The PEM keys of every registered peer, packed for a BOOTSTRAP response """
+		with self.lock:
+			keys = [ (p.encode('utf-8'), info['signature']) for p, info in self.registered.items() ]
+
+		data = struct.pack(tracker_count_fmt, len(keys))
+
+		for host, pem in keys:
+			data += struct.pack(tracker_key_fmt, len(host), len(pem)) + host + pem
+
+		return data
+
+	def handle_request(self, host, request_type, payload):
+		""" Answer one request from host, returns (status, payload) """
+		if request_type == TrackerRequest.REGISTER:
+			return self.register(host, payload), b''
+
+		if request_type == TrackerRequest.BOOTSTRAP:
+			status = self.register(host, payload)
+
+			if status != TrackerStatus.OK:
+				return status, b''
+
+			peers = self.peer_list(0, 0)
+
+			return status, struct.pack(tracker_count_fmt, len(peers)) + peers + self.all_keys()
+
+		with self.lock:
+			info = self.registered.get(host)
+
+		## If the requesting peer is not registered then the request is denied
+		if info is None:
+			return TrackerStatus.DENIED, b''
+
+		if request_type == TrackerRequest.GET_KEY:
+			## When returned from getpeername() the address is not store as bytes
+			peer = payload.decode('utf-8', 'replace')
+
+			print('Peer requested signature for %s' %(peer))
+
+			with self.lock:
+				info = self.registered.get(peer)
+
+			if info is None:
+				return TrackerStatus.UNKNOWN, b''
+
+			return TrackerStatus.OK, info['signature']
+
+		if request_type == TrackerRequest.GET_PEERS and len(payload) == struct.calcsize(peer_list_request_fmt):
+			session, since = struct.unpack(peer_list_request_fmt, payload)
+
+			return TrackerStatus.OK, self.peer_list(session, since)
+
+		return TrackerStatus.BAD_REQUEST, b''
+
+	def read_requests(self, r):
+		""" Read from a client and answer every complete request.
+			Returns False if the connection was closed.
+		"""
+		client = self.clients[r]
+
+		try:
+			data = r.recv(65536)
+		except:
+			data = b''
+
+		if not data:
+			return False
+
+		client['buffer'] += data
+		header_size = struct.calcsize(tracker_request_fmt)
+
+		while len(client['buffer']) >= header_size:
+			request_id, request_type, length = struct.unpack_from(tracker_request_fmt, client['buffer'])
+
+			if length > MAX_REQUEST_SIZE:
+				print('[ERROR] Request too large from: %s' %(client['host']))
+				return False
+
+			if len(client['buffer']) < header_size + length:
+				break
+
+			payload = bytes(client['buffer'][header_size:header_size + length])
+			del client['buffer'][:header_size + length]
+
+			status, response = self.handle_request(client['host'], request_type, payload)
+
+			try:
+				r.sendall(struct.pack(tracker_response_fmt, request_id, status, len(response)) + response)
+			except:
+				print('[INFO] Client disconnected early')
+				return False
+
+		return True
+
+	def receive_heartbeat(self):
+		""" Renew the lease of the peer that sent a heartbeat. A heartbeat is the
+			time it was sent followed by the peer's signature of it. It is ignored
+			if the peer isn't registered, the signature is invalid, or it isn't
+			newer than the peer's last heartbeat and at most LEASE_TIME old.
+		"""
+		try:
+			data, (host, port) = self.heartbeatfd.recvfrom(4096)
+		except:
+			return
+
+		size = struct.calcsize(heartbeat_fmt)
+
+		if len(data) <= size:
+			return
+
+		sent = struct.unpack_from(heartbeat_fmt, data)[0]
+
+		with self.lock:
+			info = self.registered.get(host)
+
+		if info is None or sent <= info['heartbeat'] or abs(time.time() - sent) > LEASE_TIME:
+			return
+
+		try:
+			if not PKCS1_v1_5.new(info['key']).verify(SHA256.new(data[:size]), data[size:]):
+				print('[ERROR] Invalid heartbeat signature from: %s' %(host))
+				return
+		except:
+			return
+
+		with self.lock:
+			info['heartbeat'] = sent
+			info['lease'] = time.time() + LEASE_TIME
+
 	def run(self):
 		## Create a thread to periodically ping peers
 		self.peer_ping = threading.Thread(target = self.perform_ping_check, args = ())
@@ -162,7 +422,7 @@ class Tracker:
 		## Set up the CTRL+C handler
 		signal(SIGINT, self.handler)
 
-		inputs = [ self.peerfd, self.sigfd, self.listfd ]
+		inputs = [ self.peerfd, self.heartbeatfd ]
 
 		while inputs:
 			readable, writable, exceptional = select.select(inputs, [], inputs, 10)
@@ -173,129 +433,16 @@ class Tracker:
 
 					## The server has a new connection waiting
 					print('[INFO] Connection from a new peer: ', client_address )
-					inputs.append(clientfd)
-
-					self.peers.append(clientfd)
-				elif r is self.sigfd:
-					clientfd, client_address = self.sigfd.accept()
-
-					print('[INFO] Connection from a new sig request: ', client_address )
-
-					print("ADDED sig client: ", clientfd)
 
+					clientfd.settimeout(CLIENT_TIMEOUT)
 					inputs.append(clientfd)
-					self.sigs.append(clientfd)
-				elif r is self.listfd:
-					clientfd, client_address = self.listfd.accept()
-
-					print('[INFO] Connection from a new list request: ', client_address )
-
-					host, port = clientfd.getpeername()
-
-					if host not in self.registered:
-						try:
-							clientfd.send(b'Rejected')
-						except:
-							print('[INFO] Client disconnected early')
-						clientfd.close()
-						continue
-
-					## Create a list of registered peers
-					## First let the peer know how many to expect
-					info = str(len(self.registered)) + '\n'
-
-					for p in self.registered:
-						info += p + '\n'
-
-					clientfd.send(info.encode('utf-8'))
-					clientfd.close()
-				else:					
-					## There are two possibilities. If this is a peer then they will
-					## 	send their signature otherwise it is an existing peer searching
-					##  for a public key.
-					data = r.recv(1024).rstrip(b'\n')
-
-					if data:
-						## Check if the receiver is in the peer list. If so then the
-						## 	data should be a signature
-						if r in self.peers:
-							try:
-								rsakey = RSA.importKey(data)
-							except:
-								## If it fails then the key is invalid. Respond with 'Rejected' and drop the connection
-								try:
-									r.send(b'Rejected')
-								except:
-									print('[INFO] Client disconnected before sending key rejection')
-
-								r.close()
-								self.peers.remove(r)
-								inputs.remove(r)
-
-								continue
-
-							## If this point is reached then the key is valid and we can accept the client as a peer
-							try:
-								r.send(b'Accepted')
-							except:
-								print('[INFO] Client disconnected before sending key acception')
-								r.close()
-								self.peers.remove(r)
-								inputs.remove(r)
-
-								continue
-
-							try:
-								host, port = r.getpeername()
-							except:
-								print('[ERROR] Client disconnected too soon')
-								r.close()
-								self.peers.remove(r)
-								inputs.remove(r)
-
-								continue
-
-							self.registered[host] = {'signature': data}
-
-							r.close()
-							self.peers.remove(r)
-							inputs.remove(r)
-
-						elif r in self.sigs:
-							## If the requesting peer is not registered then response is Rejected
-							host, port = r.getpeername()
-
-							if host not in self.registered:
-								r.send(b'Permission Denied')
-								r.close()
-								self.sigs.remove(r)
-								inputs.remove(r)
-
-								continue
-
-							print('Peer requested signature for %s' %(data))
-							
-							## When returned from getpeername() the address is not store as bytes
-							data = data.decode('utf-8')
-
-							if data not in self.registered:
-								r.send(struct.pack('I', 7))
-								r.send(b'Unknown')
-							else:
-								r.send(struct.pack('I', len(self.registered[data]['signature'])))
-								r.send(self.registered[data]['signature'])
-
-							r.close()
-							self.sigs.remove(r)
-							inputs.remove(r)
-
-					else:
-						if r in self.sigs:
-							self.sigs.remove(r)
-						elif r in self.peers:
-							self.peers.remove(r)
-
-						inputs.remove(r)
+					self.clients[clientfd] = {'host': client_address[0], 'buffer': bytearray()}
+				elif r is self.heartbeatfd:
+					self.receive_heartbeat()
+				elif not self.read_requests(r):
+					r.close()
+					inputs.remove(r)
+					self.clients.pop(r)
 
 p = Tracker()
 
@@ -0,0 +1,87 @@
+import hashlib
+import multiprocessing
+import struct
+
+from message import block_size, hash_header_fmt
+
+HASH_HEADER_SIZE = struct.calcsize(hash_header_fmt)
+DIGEST_SIZE = 32
+
+# Chains with at least this many headers are hashed by a process pool
+PARALLEL_THRESHOLD = 4096
+# Number of headers handed to a pool process at a time
+CHUNK_SIZE = 1024
+
+
+def parse_headers(data, start=0):
+    """
+    Walk serialized blocks (the add_block_bytes format) once and copy the hashed
+    part of every header into one contiguous buffer. A truncated last block, or one
+    of an unknown version, ends the walk.
+    @param data: serialized blocks
+    @param start: offset of the first block in data
+    @return: (headers, offsets), headers is a bytearray of HASH_HEADER_SIZE-byte
+             headers, offsets has the start of each block in data
+    """
+    headers = bytearray()
+    offsets = []
+    pos = start
+    end = len(data)
+    while True:
+        try:
+            size = block_size(data, pos)
+        except ValueError:
+            break
+        if size is None or pos + size > end:
+            break
+        headers += data[pos:pos + HASH_HEADER_SIZE]
+        offsets.append(pos)
+        pos += size
+    return headers, offsets
+
+
+def _hash_chunk(headers):
+    # sha256 of every header in a contiguous buffer, concatenated
+    view = memoryview(headers)
+    sha256 = hashlib.sha256
+    return b''.join(sha256(view[i:i + HASH_HEADER_SIZE]).digest()
+                    for i in range(0, len(headers), HASH_HEADER_SIZE))
+
+
+def hash_headers(headers, threshold=PARALLEL_THRESHOLD, processes=None):
+    """
+    Hash every header once. Long chains are split in chunks over a process pool.
+    @param headers: contiguous headers, as returned by parse_headers
+    @param threshold: minimum number of headers for using a process pool
+    @param processes: size of the pool, defaults to the number of cores
+    @return: the concatenated DIGEST_SIZE-byte digests
+    """
+    count = len(headers) // HASH_HEADER_SIZE
+    if count < threshold:
+        return _hash_chunk(headers)
+    step = CHUNK_SIZE * HASH_HEADER_SIZE
+    chunks = [bytes(headers[i:i + step]) for i in range(0, len(headers), step)]
+    with multiprocessing.Pool(processes) as pool:
+        return b''.join(pool.map(_hash_chunk, chunks))
+
+
+def verify_chain(headers, target, prev_hash, threshold=PARALLEL_THRESHOLD, processes=None):
+    """
+    Check proof of work and the prev_hash links of a run of headers.
+    Each digest is used both for its own PoW check and as the next header's prev_hash.
+    @param headers: contiguous headers, as returned by parse_headers
+    @param target: 32-byte target a valid header hash must not exceed, see difficulty.py,
+                   or a list with the target of each header
+    @param prev_hash: the hash the first header has to point to
+    @return: (valid, digests), the number of leading headers that verify and all digests
+    """
+    digests = hash_headers(headers, threshold, processes)
+    count = len(headers) // HASH_HEADER_SIZE
+    fixed = isinstance(target, bytes)
+    for i in range(count):
+        pos = i * HASH_HEADER_SIZE
+        dgst = digests[i * DIGEST_SIZE:(i + 1) * DIGEST_SIZE]
+        if headers[pos:pos + DIGEST_SIZE] != prev_hash or dgst > (target if fixed else target[i]):
+            return i, digests
+        prev_hash = dgst
+    return count, digests